@@ -0,0 +1,202 @@
+"""
+Load test of /data/ through the Flask test client against synthetic
+cases and vaccines rows for several years of history. Scenarios:
+
+- cache_hit: every request is served from the warm cache
+- cache_miss: the cache is dropped before every request
+- invalidate_storm: client threads request /data/ while another thread
+  keeps hitting /invalidate_cache/
+
+Reports latency percentiles and, from a separate tracemalloc pass (it
+slows everything down), the peak and retained allocations per request.
+Results are printed (or written with --output) as JSON, and --baseline
+compares them with an earlier run
+
+Ex. python benchmarks/bench_api.py --years 1 5 20 --output results.json
+    python benchmarks/bench_api.py --baseline results.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from synthetic import FakeDatabase, percentile
+
+INVALIDATE_KEY = "benchmark"
+os.environ["INVALIDATE_CACHE_KEY"] = INVALIDATE_KEY
+
+
+def cache_hit(app, core, client, iterations):
+    client.get("/data/")  # fill the cache
+    return [timed_get(client) for _ in range(iterations)]
+
+
+def cache_miss(app, core, client, iterations):
+    timings = []
+    for _ in range(iterations):
+        core.todays_data = None
+        timings.append(timed_get(client))
+    return timings
+
+
+def invalidate_storm(app, core, client, iterations, readers=4):
+    """
+    Readers share iterations between them while the cache is invalidated
+    every few milliseconds
+    """
+    client.get("/data/")
+    stop = threading.Event()
+
+    def invalidate():
+        invalidator = app.test_client()
+        while not stop.is_set():
+            invalidator.post("/invalidate_cache/", headers={"invalidate-cache-key": INVALIDATE_KEY})
+            time.sleep(0.005)
+
+    timings = []
+
+    def read():
+        reader = app.test_client()
+        for _ in range(iterations // readers):
+            timings.append(timed_get(reader))
+
+    storm = threading.Thread(target=invalidate)
+    threads = [threading.Thread(target=read) for _ in range(readers)]
+    storm.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    storm.join()
+    return timings
+
+
+SCENARIOS = {
+    "cache_hit": cache_hit,
+    "cache_miss": cache_miss,
+    "invalidate_storm": invalidate_storm,
+}
+
+
+def timed_get(client):
+    start = time.perf_counter()
+    response = client.get("/data/", headers={"Accept-Encoding": "gzip, br"})
+    elapsed = (time.perf_counter() - start) * 1000
+    assert response.status_code == 200, response.status_code
+    return elapsed
+
+
+def allocations(app, core, scenario, samples):
+    """
+    Peak and retained KiB per request, averaged over samples requests
+    """
+    client = app.test_client()
+    client.get("/data/")
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            if scenario != "cache_hit":
+                core.todays_data = None
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            client.get("/data/", headers={"Accept-Encoding": "gzip, br"})
+            after, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(after - before)
+    finally:
+        tracemalloc.stop()
+    return {
+        "alloc_peak_kib": round(sum(peaks) / len(peaks) / 1024, 1),
+        "alloc_retained_kib": round(sum(retained) / len(retained) / 1024, 1),
+    }
+
+
+def run(app, core, years, scenario, iterations, alloc_samples):
+    core.db.psycopg2.connect = FakeDatabase(core, years)
+    core.db.clear_pool()
+    core.todays_data = None
+    timings = SCENARIOS[scenario](app, core, app.test_client(), iterations)
+    result = {
+        "requests": len(timings),
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p95_ms": round(percentile(timings, 95), 3),
+        "p99_ms": round(percentile(timings, 99), 3),
+        "max_ms": round(max(timings), 3),
+    }
+    result.update(allocations(app, core, scenario, alloc_samples))
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    Ratio of each p50/p95/p99 to the baseline's, flagging the ones that
+    got slower by more than threshold
+    """
+    regressions = []
+    for key, result in results["results"].items():
+        before = baseline["results"].get(key)
+        if not before:
+            continue
+        for stat in ["p50_ms", "p95_ms", "p99_ms"]:
+            ratio = result[stat] / before[stat] if before[stat] else None
+            if ratio and ratio > 1 + threshold:
+                regressions.append({"scenario": key, "stat": stat, "ratio": round(ratio, 2)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--years", type=float, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--miss-iterations", type=int, default=10, help="requests for cache_miss")
+    parser.add_argument("--alloc-samples", type=int, default=3)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline", help="earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    from src.api import app, core
+
+    logging.getLogger().setLevel(logging.WARNING)
+    core.metrics.EMIT_EMF = False
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "run_at": datetime.utcnow().isoformat(),
+        "results": {},
+    }
+    for years in args.years:
+        for scenario in args.scenarios:
+            iterations = args.miss_iterations if scenario == "cache_miss" else args.iterations
+            key = f"{scenario}/{years:g}y"
+            results["results"][key] = run(
+                app.app, core, years, scenario, iterations, args.alloc_samples
+            )
+            print(key, results["results"][key], file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["regressions"] = compare(results, json.load(f), args.threshold)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if results.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Cache miss latency of /data/ before and after fetching everything with
+one combined query, with and without a warm connection pool. Uses a fake database that sleeps for a fixed time
+per connect and per query, so the numbers reflect round trips rather
+than Postgres itself
+
+Ex. python benchmarks/bench_data_miss.py --years 2 --connect-ms 40 --query-ms 8
+"""
+import argparse
+import json
+import time
+
+import legacy_data_fetch
+from synthetic import FakeDatabase, percentile
+
+
+def legacy_fetch(core):
+    return legacy_data_fetch.get_data()
+
+
+def combined_fetch(core):
+    return core.format_datasets(core.get_combined_rows(), "rows")
+
+
+def run(core, database, fetch, iterations, pooled=False):
+    core.db.psycopg2.connect = database
+    core.db.clear_pool()
+    fetch(core)  # warm up
+    timings = []
+    for _ in range(iterations):
+        if not pooled:
+            core.db.clear_pool()
+        database.connections = 0
+        start = time.perf_counter()
+        fetch(core)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "p50_ms": round(percentile(timings, 50), 2),
+        "p99_ms": round(percentile(timings, 99), 2),
+        "connections_per_miss": database.connections,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--years", type=float, default=2)
+    parser.add_argument("--connect-ms", type=float, default=40)
+    parser.add_argument("--query-ms", type=float, default=8)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    from src.api import core
+
+    database = FakeDatabase(
+        core, args.years, connect_delay=args.connect_ms / 1000, query_delay=args.query_ms / 1000
+    )
+    results = {
+        "four_queries": run(core, database, legacy_fetch, args.iterations),
+        "combined_query": run(core, database, combined_fetch, args.iterations),
+        "combined_query_warm_pool": run(
+            core, database, combined_fetch, args.iterations, pooled=True
+        ),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Cold start and warm latency of the Flask handler (app.app) against the
+native one (handler.handler). Cold starts run in a fresh interpreter
+per sample, with src/api/ on the path the way Lambda loads it, and
+time the import plus the first /data/ request (a cache miss against
+a fake database). Warm numbers are cache hits in one process
+
+Ex. python benchmarks/bench_handler.py --cold-starts 10 --iterations 500
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from synthetic import ROOT, FakeDatabase, percentile
+
+API_DIR = os.path.join(ROOT, "src", "api")
+HANDLERS = {"flask": ("app", "app"), "native": ("handler", "handler")}
+
+COLD_START = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+sys.path.insert(0, {benchmarks!r})
+import bench_handler, core
+from synthetic import FakeDatabase
+core.db.psycopg2.connect = FakeDatabase(core, {years})
+first = time.perf_counter()
+{module}.{handler}(bench_handler.data_event(), None)
+done = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - start) * 1000,
+    "first_request_ms": (done - first) * 1000,
+    "modules": len(sys.modules),
+    "flask_loaded": "flask" in sys.modules,
+}}))
+"""
+
+
+def data_event(path="/data/"):
+    return {
+        "httpMethod": "GET",
+        "path": path,
+        "body": None,
+        "queryStringParameters": None,
+        "requestContext": {"identity": {"sourceIp": "127.0.0.1"}},
+        "headers": {
+            "Host": "example.execute-api.us-east-1.amazonaws.com",
+            "X-Forwarded-Port": "443",
+            "X-Forwarded-Proto": "https",
+            "Accept-Encoding": "gzip, deflate, br",
+            "Origin": "https://example.org",
+        },
+    }
+
+
+def cold_start(module, handler, years):
+    script = COLD_START.format(
+        module=module, handler=handler, years=years, benchmarks=os.path.dirname(__file__)
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=API_DIR,
+        env=dict(os.environ, PYTHONPATH=API_DIR),
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_cold(module, handler, years, samples):
+    results = [cold_start(module, handler, years) for _ in range(samples)]
+    imports = [result["import_ms"] for result in results]
+    first_requests = [result["first_request_ms"] for result in results]
+    return {
+        "import_p50_ms": round(percentile(imports, 50), 2),
+        "first_request_p50_ms": round(percentile(first_requests, 50), 2),
+        "modules_loaded": results[0]["modules"],
+        "flask_loaded": results[0]["flask_loaded"],
+    }
+
+
+def run_warm(handler, iterations):
+    event = data_event()
+    handler(event, None)  # fill the cache
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        handler(event, None)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p99_ms": round(percentile(timings, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--years", type=float, default=2)
+    parser.add_argument("--cold-starts", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    sys.path.insert(0, API_DIR)
+    import core
+
+    core.db.psycopg2.connect = FakeDatabase(core, args.years)
+    results = {}
+    for name, (module, handler) in HANDLERS.items():
+        results[name] = {
+            "cold": run_cold(module, handler, args.years, args.cold_starts),
+            "warm": run_warm(getattr(__import__(module), handler), args.iterations),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Times increases.add_increases against a row by row loop like the ones
+it replaced in cases.py and vaccines.py, over a number of days and
+increasingly many cumulative columns
+
+Ex. python benchmarks/bench_increases.py --days 1000 --columns 4 16 64
+"""
+import argparse
+import random
+import time
+
+import synthetic  # noqa: F401 puts the repo root on sys.path
+
+from src.data import increases
+
+
+def python_loop(records, pairs):
+    for i, record in enumerate(records):
+        for cumulative, increase in pairs:
+            if i == 0:
+                record[increase] = record.get(cumulative)
+                continue
+            try:
+                record[increase] = record.get(cumulative) - records[i - 1].get(cumulative, 0)
+            except TypeError:
+                record[increase] = None
+    return records
+
+
+def synthetic_records(days, columns, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for day in range(days):
+        records.append(
+            {f"c{column}": day * 1000 + rng.randint(0, 999) for column in range(columns)}
+        )
+    return records
+
+
+def best_ms(add, days, columns, repeat):
+    pairs = [(f"c{column}", f"i{column}") for column in range(columns)]
+    timings = []
+    for _ in range(repeat):
+        records = synthetic_records(days, columns)
+        start = time.perf_counter()
+        add(records, pairs)
+        timings.append(time.perf_counter() - start)
+    return round(min(timings) * 1000, 2), records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=1000)
+    parser.add_argument("--columns", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for columns in args.columns:
+        loop_ms, expected = best_ms(python_loop, args.days, columns, args.repeat)
+        engine_ms, records = best_ms(increases.add_increases, args.days, columns, args.repeat)
+        assert records == expected, "results differ"
+        print(f"{args.days} days x {columns} columns: loop {loop_ms} ms, add_increases {engine_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Times vaccines.clean_vaccine_data against the multi-pass cleaning it
+replaced (legacy_vaccine_clean.py) over synthetic feature rows for a
+number of days, checking both give the same records, key order included
+
+Ex. python benchmarks/bench_vaccine_clean.py --days 365
+"""
+import argparse
+import copy
+import json
+import logging
+import time
+from datetime import date, timedelta
+
+import synthetic  # noqa: F401 puts the repo root on sys.path
+
+import legacy_vaccine_clean
+from src.data import vaccines
+
+PUBLISH_DATE = date(2021, 12, 31)
+RUN = {"new_day": PUBLISH_DATE.strftime("%m/%d/%Y")}
+ADMINISTRATION = [
+    (vaccine, metric)
+    for vaccine in ["All COVID Vaccines", "Pfizer", "Moderna", "Janssen"]
+    for metric in ["Cumulative Daily", "Daily", "Weekly Rolling"]
+]
+ADMINISTRATION += [(None, "People Immunized with One Dose"), (None, "People Fully Immunized")]
+ADMINISTRATION += [("Unspecified COVID Vaccine", "Daily"), ("Novavax", "Daily")]
+STATE = ["Cumulative Doses Administered", "Cumulative Doses Distributed", "Total Vaccine Providers"]
+
+
+def feature(publish_date, day, category, section, metric, type, value):
+    properties = {
+        "publish_date": publish_date.strftime("%m/%d/%Y"),
+        "date": day.strftime("%m/%d/%Y"),
+        "category": category,
+        "section": section,
+        "metric": metric,
+        "type": type,
+        "value": value,
+    }
+    return {"type": "Feature", "properties": properties, "geometry": None}
+
+
+def synthetic_features(days):
+    """
+    The latest publish's administration counts for every day, the state
+    counts each day was published with, an older publish and demographic
+    rows cleaning ignores, plus a few empty and non-numeric values
+    """
+    features = []
+    for offset in range(days):
+        day = PUBLISH_DATE - timedelta(days=days - offset)
+        for i, (vaccine, metric) in enumerate(ADMINISTRATION):
+            value = offset * 100 + i if (offset + i) % 97 else None
+            for publish_date in [PUBLISH_DATE, PUBLISH_DATE - timedelta(days=1)]:
+                features.append(
+                    feature(publish_date, day, "Administration", "Doses", metric, vaccine, value)
+                )
+        for i, metric in enumerate(STATE):
+            value = "n/a" if offset % 50 == 0 and metric == STATE[2] else str(offset * 1000 + i)
+            features.append(
+                feature(day, day, "Cumulative counts to date", "State Data", metric, None, value)
+            )
+        for section in ["Age", "Gender", "Race/Ethnicity", "County"] * 3:
+            features.append(feature(day, day, "Demographics", section, "Percent", None, 1))
+    return {"type": "FeatureCollection", "features": features}
+
+
+def best_ms(clean, raw_data, since, repeat):
+    timings = []
+    for _ in range(repeat):
+        features = copy.deepcopy(raw_data)  # the old cleaning writes to its input
+        start = time.perf_counter()
+        records = clean(features, RUN, since=since)
+        timings.append(time.perf_counter() - start)
+    return round(min(timings) * 1000, 2), records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)  # unknown keys are logged per row
+
+    raw_data = synthetic_features(args.days)
+    print(f"{len(raw_data['features'])} features over {args.days} days")
+    for since in [None, PUBLISH_DATE - timedelta(days=14)]:
+        legacy_ms, expected = best_ms(
+            legacy_vaccine_clean.clean_vaccine_data, raw_data, since, args.repeat
+        )
+        single_pass_ms, records = best_ms(
+            vaccines.clean_vaccine_data, raw_data, since, args.repeat
+        )
+        assert json.dumps(records) == json.dumps(expected), "outputs differ"
+        print(
+            f"  since {since}: {len(records)} records, multi-pass {legacy_ms} ms, "
+            f"single pass {single_pass_ms} ms ({legacy_ms / single_pass_ms:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
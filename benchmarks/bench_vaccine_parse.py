@@ -0,0 +1,126 @@
+"""
+Peak memory of parsing the vaccine GeoJSON download whole (res.json(),
+str() of it for the date check, then the list of properties) against
+streaming it with fetch.iter_features, over a synthetic download of a
+given number of features. The raw bytes stand in for the response body
+in both, so they aren't counted. Then times clean_vaccine_data on the
+features streaming keeps, which needs no database given a run context
+
+Ex. python benchmarks/bench_vaccine_parse.py --features 50000 200000
+"""
+import argparse
+import json
+import logging
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+
+import synthetic  # noqa: F401 puts the repo root on sys.path
+
+from src.data import fetch, vaccines
+
+NEW_DAY = "03/05/2021"
+RUN = {"new_day": NEW_DAY}
+ADMINISTRATION_TYPES = ["All COVID Vaccines", "Pfizer", "Moderna", "Janssen"]
+STATE_METRICS = ["Cumulative Doses Distributed", "Total Vaccine Providers"]
+DEMOGRAPHICS = ["Age", "Race/Ethnicity", "Gender", "County"]
+
+
+class StreamedBody:
+    """Just enough of a requests response for iter_features"""
+
+    url = "synthetic"
+
+    def __init__(self, body):
+        self.body = body
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start : start + chunk_size]
+
+
+def synthetic_geojson(count):
+    """
+    A day's administration and state rows for as many days as fit in
+    count features, padded out with demographic rows like the real
+    dataset, which are most of it
+    """
+    features = []
+    day = 0
+    while len(features) < count:
+        date = (fetch.parse_date(NEW_DAY) - timedelta(days=day)).strftime("%m/%d/%Y")
+        rows = [("Administration", "Doses", "Cumulative Daily", t) for t in ADMINISTRATION_TYPES]
+        rows += [("Cumulative counts to date", "State Data", m, "") for m in STATE_METRICS]
+        rows += [("Demographics", section, "Percent", "") for section in DEMOGRAPHICS] * 5
+        for category, section, metric, kind in rows:
+            properties = {
+                "publish_date": NEW_DAY if category == "Administration" else date,
+                "date": date,
+                "category": category,
+                "section": section,
+                "metric": metric,
+                "type": kind,
+                "value": 1000000 - day,
+            }
+            features.append({"type": "Feature", "properties": properties, "geometry": None})
+        day += 1
+    body = {"type": "FeatureCollection", "features": features[:count]}
+    return json.dumps(body).encode("utf-8")
+
+
+def wanted(cat):
+    return vaccines.is_administration_count(cat, NEW_DAY) or vaccines.is_state_count(cat)
+
+
+def parse_whole(body):
+    raw_data = json.loads(body)
+    assert NEW_DAY in str(raw_data)
+    daily_data = [feature["properties"] for feature in raw_data["features"]]
+    return [cat for cat in daily_data if wanted(cat)]
+
+
+def parse_streamed(body):
+    with tempfile.TemporaryFile() as raw_file:
+        features = fetch.iter_features(StreamedBody(body), raw_file)
+        return [feature for feature in features if wanted(feature["properties"])]
+
+
+def time_cleaning(body, repeat=5):
+    features = parse_streamed(body)
+    timings = []
+    for _ in range(repeat):
+        # cleaning adds keys to the properties it keeps
+        raw_data = {"features": json.loads(json.dumps(features))}
+        start = time.perf_counter()
+        days = vaccines.clean_vaccine_data(raw_data, RUN)
+        timings.append(time.perf_counter() - start)
+    return {"days": len(days), "best_ms": round(min(timings) * 1000, 2)}
+
+
+def measure(parse, body):
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = parse(body)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"kept": len(kept), "peak_mib": round(peak / 2 ** 20, 1), "seconds": round(elapsed, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features", type=int, nargs="+", default=[50000, 200000])
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for count in args.features:
+        body = synthetic_geojson(count)
+        print(f"{count} features, {len(body) / 2 ** 20:.1f} MiB")
+        for parse in [parse_whole, parse_streamed]:
+            print(f"  {parse.__name__}: {measure(parse, body)}")
+        print(f"  clean_vaccine_data: {time_cleaning(body)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+How /data/ was fetched before the combined query: four queries, each on
+a connection of its own, with the weekly averages computed by a window
+in Postgres. Unchanged apart from sharing the column lists and row
+formatting with src/api/core.py. Kept as the "before" of the cache miss
+benchmark
+"""
+import psycopg2
+
+import synthetic  # noqa: F401 puts the repo root on sys.path
+
+from src.api import core
+
+
+def get_formatted_daily_data(table, values):
+    sql = f'SELECT {", ".join(values)} FROM {table} ORDER BY reporting_date ASC;'
+    data = fetch_data(sql)
+    return core.format_data(data, values)
+
+
+def get_formatted_averaged_data(table, values):
+    ave_sql = []
+    for value in values[1:]:  # don't average reporting_date
+        ave_sql.append(
+            f"ROUND(AVG({value}) OVER(ORDER BY reporting_date ROWS BETWEEN 6 PRECEDING AND CURRENT ROW)) AS avg_{value}"
+        )
+    sql = f'SELECT reporting_date, {", ".join(ave_sql)} FROM {table} ORDER BY reporting_date ASC;'
+    data = fetch_data(sql)
+    return core.format_data(data, values)
+
+
+def fetch_data(sql):
+    conn = psycopg2.connect(core.db.DB_CREDENTIALS)
+    cur = conn.cursor()
+    cur.execute(sql)
+    data = cur.fetchall()
+    conn.close()
+    return data
+
+
+def get_data():
+    return {
+        "daily_cases": get_formatted_daily_data("cases", core.DAILY_CASES_COLUMNS),
+        "daily_vaccines": get_formatted_daily_data("vaccines", core.DAILY_VACCINES_COLUMNS),
+        "ave_cases": get_formatted_averaged_data("cases", core.AVE_CASES_COLUMNS),
+        "ave_vaccines": get_formatted_averaged_data("vaccines", core.AVE_VACCINES_COLUMNS),
+    }
@@ -0,0 +1,196 @@
+"""
+The multi-pass vaccine cleaning vaccines.clean_vaccine_data replaced,
+unchanged apart from taking new_day as an argument. Kept to check the
+single pass gives the same output and to time the two against each
+other
+"""
+import logging
+from datetime import datetime
+
+import synthetic  # noqa: F401 puts the repo root on sys.path
+
+from src.data import fetch
+
+logger = logging.getLogger()
+
+
+def clean_vaccine_data(raw_data, run, since=None):
+    daily_data = extract_vaccine_data(raw_data)
+    administration_counts, state_counts = filter_latest_vaccine_data(
+        daily_data, run["new_day"]
+    )
+    flattened_data = flatten_data(administration_counts, run["new_day"])
+    combined_data = combine_counts(flattened_data, state_counts)
+    sorted_data = sort_data(combined_data)
+    if since is not None:
+        first = next(
+            (i for i, day in enumerate(sorted_data) if fetch.parse_date(day["date"]) >= since),
+            len(sorted_data),
+        )
+        sorted_data = sorted_data[max(first - 1, 0) :]
+    standardized_data = standardize_metric_names(sorted_data)
+    cleaned_data = add_metric_increases(standardized_data)
+
+    if since is None:
+        return cleaned_data
+    return [day for day in cleaned_data if fetch.parse_date(day["date"]) >= since]
+
+
+def extract_vaccine_data(raw_data):
+    daily_data = raw_data["features"]
+    return [day["properties"] for day in daily_data]
+
+
+def filter_latest_vaccine_data(daily_data, new_day):
+    administration_counts = []
+    state_counts = []
+    for cat in daily_data:
+        if is_administration_count(cat, new_day):
+            administration_counts.append(cat)
+        if is_state_count(cat):
+            state_counts.append(cat)
+            state_counts[-1]["date"] = state_counts[-1]["publish_date"]
+    return administration_counts, state_counts
+
+
+def is_administration_count(cat, new_day):
+    return (
+        cat["publish_date"] == new_day
+        and cat["category"] == "Administration"
+        and cat["metric"] != "Weekly"
+        and cat["type"] != "Unspecified COVID Vaccine"
+    )
+
+
+def is_state_count(cat):
+    return cat["category"] == "Cumulative counts to date" and cat["section"] == "State Data"
+
+
+def flatten_data(days, new_day):
+    return [
+        {
+            "metric": day["metric"],
+            "type": day["type"],
+            "date": day["date"],
+            "value": day["value"],
+            "publish_date": day["publish_date"],
+        }
+        for day in days
+        if day["publish_date"] == new_day
+    ]
+
+
+def combine_counts(flattened_data, state_counts):
+    combined_daily = {}
+    for day in flattened_data:
+        if not combined_daily.get(day["date"]):
+            combined_daily[day["date"]] = {}
+        try:
+            combined_daily[day["date"]][day["type"] + " " + day["metric"]] = day[
+                "value"
+            ]
+        except:
+            combined_daily[day["date"]][day["metric"]] = day["value"]
+
+    for day in state_counts:
+        if not combined_daily.get(day["date"]):
+            combined_daily[day["date"]] = {}
+        combined_daily[day["date"]][day["metric"]] = day["value"]
+
+    return [{"date": day[0], **day[1]} for day in combined_daily.items()]
+
+
+def standardize_metric_names(sorted_data):
+    replacements = {
+        "All COVID Vaccines Cumulative Daily": "daily_cumulative",
+        "Moderna Cumulative Daily": "moderna_cumulative",
+        "Pfizer Cumulative Daily": "pfizer_cumulative",
+        "Janssen Cumulative Daily": "jandj_cumulative",
+        "All COVID Vaccines Daily": "daily",
+        "Moderna Daily": "moderna_daily",
+        "Pfizer Daily": "pfizer_daily",
+        "Janssen Daily": "jandj_daily",
+        "People Immunized with One Dose": "one_dose_cumulative",
+        "People Fully Immunized": "fully_immunized_cumulative",
+        "date": "date",
+        "Cumulative Doses Administered": "daily_cumulative_2",
+        "Cumulative Doses Distributed": "distributed_cumulative",
+        "Total Vaccine Providers": "total_vaccine_providers",
+    }
+    updated_data = []
+    for day in sorted_data:
+        temp_day = {}
+        for key, val in day.items():
+            if "Weekly" in key:
+                continue
+            try:
+                temp_day[replacements[key]] = int(val)
+            except KeyError:
+                logger.error(f"Found unknown key: {key}")
+            except TypeError as e:
+                logger.error(f"Found unknown type: {e} for key {key}")
+            except ValueError:
+                temp_day[replacements[key]] = val
+        updated_data.append(temp_day)
+
+    for day in updated_data:
+        if day.get("daily_cumulative_2"):
+            day["daily_cumulative"] = int(day.get("daily_cumulative_2"))
+            del day["daily_cumulative_2"]
+        if day.get("daily"):  # confusing metric that isn't what it says
+            del day["daily"]
+    return updated_data
+
+
+def add_metric_increases(standardized_data):
+    total_days = len(standardized_data)
+    for i in range(total_days):
+        if i == 0:
+            standardized_data[i]["daily_increase"] = standardized_data[i].get(
+                "daily_cumulative"
+            )
+            standardized_data[i]["distributed_increase"] = standardized_data[i].get(
+                "distributed_cumulative"
+            )
+            standardized_data[i]["one_dose_increase"] = standardized_data[i].get(
+                "one_dose_cumulative"
+            )
+            standardized_data[i]["fully_immunized_increase"] = standardized_data[i].get(
+                "fully_immunized_cumulative"
+            )
+        else:
+            try:
+                standardized_data[i]["daily_increase"] = standardized_data[i].get(
+                    "daily_cumulative"
+                ) - standardized_data[i - 1].get("daily_cumulative", 0)
+            except TypeError:
+                standardized_data[i]["daily_increase"] = None
+
+            try:
+                standardized_data[i]["distributed_increase"] = standardized_data[i].get(
+                    "distributed_cumulative"
+                ) - standardized_data[i - 1].get("distributed_cumulative", 0)
+            except TypeError:
+                standardized_data[i]["distributed_increase"] = None
+
+            try:
+                standardized_data[i]["one_dose_increase"] = standardized_data[i].get(
+                    "one_dose_cumulative"
+                ) - standardized_data[i - 1].get("one_dose_cumulative", 0)
+            except TypeError:
+                standardized_data[i]["one_dose_increase"] = None
+            try:
+                standardized_data[i]["fully_immunized_increase"] = standardized_data[
+                    i
+                ].get("fully_immunized_cumulative") - standardized_data[i - 1].get(
+                    "fully_immunized_cumulative", 0
+                )
+            except TypeError:
+                standardized_data[i]["fully_immunized_increase"] = None
+    return standardized_data
+
+
+def sort_data(combined_data):
+    return sorted(
+        combined_data, key=lambda day: datetime.strptime(day["date"], "%m/%d/%Y")
+    )
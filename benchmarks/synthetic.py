@@ -0,0 +1,157 @@
+"""
+Synthetic cases and vaccines rows plus a fake psycopg2 connection for
+benchmarking the API without a database. The fake connection can add a
+fixed delay per connect and per query to stand in for the TLS handshake
+and network round trip to RDS
+"""
+import os
+import random
+import re
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+START_DATE = date(2020, 3, 1)
+
+
+def synthetic_table(columns, days, seed=0):
+    """
+    One row per day with the given columns. Dates and timestamps are
+    filled in by name, everything else is a random integer
+    """
+    rng = random.Random(seed)
+    rows = []
+    for day in range(days):
+        reporting_date = START_DATE + timedelta(days=day)
+        row = []
+        for column in columns:
+            if column == "reporting_date":
+                row.append(reporting_date)
+            elif column in ["created_at", "updated_at"]:
+                row.append(datetime.combine(reporting_date, datetime.min.time()) + timedelta(hours=23))
+            else:
+                row.append(rng.randint(0, 100000))
+        rows.append(tuple(row))
+    return rows
+
+
+def select_columns(sql, table):
+    """
+    Select list of the innermost SELECT reading from table
+    """
+    select_list = re.search(rf"SELECT ((?:(?!SELECT).)*?) FROM {table}\b", sql, re.S).group(1)
+    return [column.strip() for column in select_list.split(",")]
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        time.sleep(self.connection.query_delay)
+        self.connection.queries += 1
+        self.rows = self.connection.rows_for(sql)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, tables, query_delay):
+        self.tables = tables
+        self.query_delay = query_delay
+        self.queries = 0
+        self.closed = 0
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self)
+
+    def rows_for(self, sql):
+        if "FROM data_version" in sql:
+            return [(1,)]
+        if "FROM invokes" in sql:
+            return []
+        if "FULL OUTER JOIN" in sql:
+            return self.joined_rows(sql)
+        table = re.search(r"FROM (cases|vaccines)\b", sql).group(1)
+        return self.table_rows(table, select_columns(sql, table))
+
+    def table_rows(self, table, columns):
+        source_columns, source_rows = self.tables[table]
+        indexes = []
+        for column in columns:
+            name = re.sub(r".*AVG\((\w+)\).*", r"\1", column)
+            indexes.append((source_columns.index(name), "AVG(" in column))
+        return [
+            tuple(Decimal(row[i]) if averaged else row[i] for i, averaged in indexes)
+            for row in source_rows
+        ]
+
+    def joined_rows(self, sql):
+        cases = self.table_rows("cases", select_columns(sql, "cases"))
+        vaccines = self.table_rows("vaccines", select_columns(sql, "vaccines"))
+        width = len(cases[0])
+        rows = []
+        for i in range(max(len(cases), len(vaccines))):
+            left = cases[i] if i < len(cases) else (None,) * width
+            right = vaccines[i] if i < len(vaccines) else (None,) * len(vaccines[0])
+            rows.append(left + right)
+        return rows
+
+    def get_transaction_status(self):
+        return 0  # idle
+
+    def poll(self):
+        return 0
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeDatabase:
+    """
+    Callable stand-in for psycopg2.connect that counts connections
+    """
+
+    def __init__(self, core, years, connect_delay=0.0, query_delay=0.0):
+        days = int(365 * years)
+        self.tables = {
+            "cases": (core.DAILY_CASES_COLUMNS, synthetic_table(core.DAILY_CASES_COLUMNS, days)),
+            "vaccines": (
+                core.DAILY_VACCINES_COLUMNS,
+                synthetic_table(core.DAILY_VACCINES_COLUMNS, days, seed=1),
+            ),
+        }
+        self.connect_delay = connect_delay
+        self.query_delay = query_delay
+        self.connections = 0
+
+    def __call__(self, *args, **kwargs):
+        time.sleep(self.connect_delay)
+        self.connections += 1
+        return FakeConnection(self.tables, self.query_delay)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
@@ -5,10 +5,16 @@ Ex. python backfill_hospital.py ./scripts/files/covid19_hospital_data_2021-03-08
 """
 
 import csv
+import os
 import sys
 
 import psycopg2
 
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from src.data import db  # noqa: E402 needs the repo root on sys.path
 
 if __name__ == "__main__":
     """
@@ -35,6 +41,8 @@ if __name__ == "__main__":
         print("Saving", day)
         sql = f"UPDATE cases SET hospitalized_currently = {day['value']} WHERE reporting_date = '{day['reporting_date']}';"
         cur.execute(sql)
+    # so every warm API container picks the new values up, not just after its TTL
+    db.bump_data_version(cur)
 
     conn.commit()
     conn.close()
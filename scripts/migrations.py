@@ -34,6 +34,36 @@ cur.execute(sql)
 sql = """CREATE TABLE IF NOT EXISTS invokes (id SERIAL PRIMARY KEY, function_name varchar(40) NOT NULL,
     invoke_time timestamp not null default CURRENT_TIMESTAMP, new_data boolean);"""
 
+cur.execute(sql)
+
+# single row bumped by the data functions on every write so API caches know to refresh
+sql = """CREATE TABLE IF NOT EXISTS data_version (id integer PRIMARY KEY, version bigint NOT NULL DEFAULT 0,
+    updated_at timestamp not null default CURRENT_TIMESTAMP);"""
+
+cur.execute(sql)
+
+sql = "INSERT INTO data_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;"
+
+cur.execute(sql)
+
+# the API cache only merges rows whose updated_at moved, so keep it current on
+# every update, including ones run by hand or by scripts that don't set it
+sql = """CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$
+    BEGIN
+        NEW.updated_at = now();
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;"""
+
+cur.execute(sql)
+
+for table in ["cases", "vaccines"]:
+    cur.execute(f"DROP TRIGGER IF EXISTS {table}_updated_at ON {table};")
+    cur.execute(
+        f"""CREATE TRIGGER {table}_updated_at BEFORE UPDATE ON {table}
+        FOR EACH ROW EXECUTE PROCEDURE set_updated_at();"""
+    )
+
 conn.commit()
 conn.close()
 
@@ -0,0 +1,963 @@
+"""
+Everything the API serves apart from the web framework: loading and
+caching the data, slicing it and encoding the responses. Kept free of
+Flask so the native Lambda handler can use it without importing Flask
+"""
+import os
+import csv
+import decimal
+import gzip
+import hashlib
+import io
+import json
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from email.utils import format_datetime
+import logging
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, clients fall back to gzip
+    brotli = None
+
+try:
+    from . import db, metrics
+except ImportError:  # Lambda loads src/api/ as top level modules
+    import db
+    import metrics
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+INVALIDATE_CACHE_KEY = os.getenv("INVALIDATE_CACHE_KEY")
+if not INVALIDATE_CACHE_KEY:
+    logger.error({"error": "no invalidate cache key found"})
+
+# stores the full data set as rows from the DB, the newest updated_at per table,
+# the encoded payload for each response format built from the rows and the
+# payloads cut from them for since/until/fields and /series/ requests (least
+# recently used first); global var to cache data with Lambda. Refreshes build a new dict and
+# swap it in, so a request holding the old one never sees it change
+todays_data = {}
+refresh_lock = threading.Lock()  # held while data is loading, so only one load runs
+refresh_count = 0  # bumped every time todays_data is replaced
+background_refresh = None  # thread of the latest stale-while-revalidate refresh
+STALE_WHILE_REVALIDATE = os.getenv("STALE_WHILE_REVALIDATE", "true").lower() == "true"
+SLICE_CACHE_SIZE = int(os.getenv("SLICE_CACHE_SIZE", "32"))
+# how long a container goes on the last data version it read before reading it again
+DATA_VERSION_CHECK_SECONDS = float(os.getenv("DATA_VERSION_CHECK_SECONDS", "10"))
+data_version_checked = None  # (time.monotonic() of the last check, version it read)
+CACHE_TTL = timedelta(minutes=int(os.getenv("CACHE_TTL_MINUTES", "360")))
+# brotli's default (11) is ~30% smaller than 5 but takes seconds for a few years
+# of data, which every cache miss waits on
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "500"))
+# the data functions only run from 22:00 to 03:00 UTC (the Schedule events in
+# template.yaml), so outside of it browsers and CDNs can keep responses until
+# the next window opens
+UPDATE_WINDOW_START_HOUR = 22
+UPDATE_WINDOW_HOURS = 5
+UPDATE_FUNCTIONS = ["cases", "vaccines"]
+UPDATE_WINDOW_MAX_AGE = 60  # seconds, while new data may still show up
+CACHE_CONTROL_SWR = int(os.getenv("CACHE_CONTROL_SWR_SECONDS", "300"))
+SERIES_DEFAULT_POINTS = 500
+SERIES_MAX_POINTS = 5000
+
+WINDOW_PRECEDING_ROWS = 6
+
+DAILY_CASES_COLUMNS = [
+    "reporting_date",
+    "positive",
+    "hospitalized_currently",
+    "death_confirmed",
+    "positive_increase",
+    "death_increase",
+    "hospitalized_increase",
+    "tested",
+    "tested_increase",
+    "total_hospitalized",
+    "created_at",
+    "updated_at",
+]
+AVE_CASES_COLUMNS = [
+    "reporting_date",
+    "hospitalized_currently",
+    "positive_increase",
+    "death_increase",
+    "hospitalized_increase",
+    "tested_increase",
+]
+DAILY_VACCINES_COLUMNS = [
+    "reporting_date",
+    "daily_qty",
+    "daily_cumulative",
+    "one_dose_increase",
+    "one_dose_total",
+    "fully_immunized_increase",
+    "fully_immunized_total",
+    "daily_pfizer",
+    "daily_moderna",
+    "daily_jandj",
+    "pfizer_total",
+    "moderna_total",
+    "jandj_total",
+    "distributed_increase",
+    "distrubuted_total",
+    "total_vaccine_providers",
+    "created_at",
+    "updated_at",
+]
+AVE_VACCINES_COLUMNS = [
+    "reporting_date",
+    "daily_qty",
+    "one_dose_increase",
+    "fully_immunized_increase",
+    "daily_pfizer",
+    "daily_moderna",
+    "daily_jandj",
+    "distributed_increase",
+]
+DATASET_COLUMNS = {
+    "daily_cases": DAILY_CASES_COLUMNS,
+    "daily_vaccines": DAILY_VACCINES_COLUMNS,
+    "ave_cases": AVE_CASES_COLUMNS,
+    "ave_vaccines": AVE_VACCINES_COLUMNS,
+}
+TABLE_DATASETS = {
+    "cases": ("daily_cases", "ave_cases"),
+    "vaccines": ("daily_vaccines", "ave_vaccines"),
+}
+KNOWN_COLUMNS = {value for values in DATASET_COLUMNS.values() for value in values}
+TIME_COLUMNS = ["created_at", "updated_at"]
+# daily data set each column /series/ can plot comes from
+SERIES_COLUMNS = {
+    value: name
+    for name in ["daily_cases", "daily_vaccines"]
+    for value in DATASET_COLUMNS[name][1:]
+    if value not in TIME_COLUMNS
+}
+SERIES_ALGORITHMS = ["lttb", "weekly", "monthly"]
+
+
+def data_response(args, headers):
+    """
+    Response to a /data/ request as (body, status, headers). args is the
+    query string and headers the request headers, both read with .get
+    and lower case header names
+    """
+    response_format = args.get("format", "rows")
+    if response_format not in RESPONSE_FORMATS:
+        return json_response({"error": f"unknown format {response_format}"}, 400)
+    try:
+        since, until, fields, columns = get_data_params(args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    cached = refresh_data()
+    if since or until or fields:
+        payload = get_sliced_payload(cached, response_format, since, until, fields, columns)
+        return encoded_response(payload, headers, cached)
+
+    payloads = cached["payloads"]
+    if response_format not in payloads:
+        data = format_datasets(cached["datasets"], response_format)
+        payloads[response_format] = build_payload(data, cached["last_updated"])
+    return encoded_response(payloads[response_format], headers, cached)
+
+
+def invalidate_cache(key):
+    global todays_data
+    if key != INVALIDATE_CACHE_KEY:
+        logger.info({"status": "unauthorized request to invalidate cache"})
+        return json_response({"status": "unauthorized"}, 403)
+    with refresh_lock:
+        todays_data = None
+    return json_response({"status": "success"})
+
+
+def metrics_response():
+    return json_response(metrics.summary())
+
+
+def health_response():
+    logger.info({"status": "health check ok"})
+    return json_response({"status": "ok", "db_pool": db.pool_stats})
+
+
+def series_response(args, headers):
+    """
+    Response to a /series/ request as (body, status, headers): one daily
+    column downsampled for charts, memoized along with the slices
+    """
+    try:
+        column, points, algorithm = get_series_params(args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    cached = refresh_data()
+
+    def build():
+        with metrics.timed("format"):
+            dates, values = downsample_series(cached["datasets"], column, points, algorithm)
+        data = {"column": column, "algorithm": algorithm, "reporting_date": dates, column: values}
+        return build_payload(data, cached["last_updated"])
+
+    payload = get_cached_slice(cached, ("series", column, points, algorithm), build)
+    return encoded_response(payload, headers, cached)
+
+
+def export_response(table, args):
+    """
+    Response to an /export/<table> request as (body, status, headers),
+    where body is an iterator of encoded chunks streamed from the DB
+    """
+    if table not in TABLE_DATASETS:
+        return json_response({"error": f"unknown table {table}"}, 404)
+    export_format = args.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return json_response({"error": f"unknown format {export_format}"}, 400)
+    try:
+        since = parse_date(args.get("since"), "since")
+        until = parse_date(args.get("until"), "until")
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    if since and until and since > until:
+        return json_response({"error": "since must not be after until"}, 400)
+
+    values = DATASET_COLUMNS[TABLE_DATASETS[table][0]]
+    conditions, params = range_conditions(since, until)
+    sql = f'SELECT {", ".join(values)} FROM {table}{where_sql(conditions)} ORDER BY reporting_date ASC;'
+    headers = {
+        "Content-Type": EXPORT_FORMATS[export_format][0],
+        "Content-Disposition": f'attachment; filename="{table}.{export_format}"',
+    }
+    return export_chunks(sql, params, values, export_format), 200, headers
+
+
+def export_chunks(sql, params, values, export_format):
+    _, header, encode_rows = EXPORT_FORMATS[export_format]
+    if header:
+        yield header(values)
+    for rows in db.stream_data(sql, params, chunk_size=EXPORT_CHUNK_ROWS):
+        yield encode_rows(format_data(rows, values))
+
+
+def csv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue().encode("utf-8")
+
+
+def csv_rows(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows(row.values() for row in rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+def ndjson_rows(rows):
+    return "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows).encode("utf-8")
+
+
+# content type, header line from the column names and encoder for formatted rows
+EXPORT_FORMATS = {
+    "csv": ("text/csv", csv_line, csv_rows),
+    "ndjson": ("application/x-ndjson", None, ndjson_rows),
+}
+
+
+def json_response(data, status=200):
+    body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return body, status, {"Content-Type": "application/json"}
+
+
+def data_still_valid(date):
+    """
+    Checks if the last updated time is cached, and if it is
+    checks whether it is valid. A time is valid for CACHE_TTL
+    or until it is cleared. The data version check is what normally
+    catches new data, so the TTL is only a backstop
+    """
+    current_time = datetime.utcnow()
+    last_updated = datetime.strptime(date, "%Y-%m-%d %H:%M:%S.%f")
+    if current_time - last_updated < CACHE_TTL:
+        return True
+    return False
+
+
+def refresh_data():
+    """
+    Returns todays_data, making sure it's current first. If there is
+    cached data that's out of date it is served as is while a background
+    thread refreshes it (unless STALE_WHILE_REVALIDATE is off). With
+    nothing cached the request loads the data, and any requests arriving
+    meanwhile wait for that one load instead of starting their own
+    """
+    global background_refresh
+
+    # read before the rows so a write that lands mid-load bumps it again
+    version = get_data_version()
+    cached = todays_data
+    if cached and data_still_valid(cached["last_updated"]):
+        if version is None or version == cached["data_version"]:
+            logger.info({"status": "using cached data"})
+            metrics.count("cache_hits")
+            return cached
+        logger.info({"status": "data version changed", "version": version})
+
+    if cached and STALE_WHILE_REVALIDATE:
+        if refresh_lock.acquire(blocking=False):
+            background_refresh = threading.Thread(
+                target=refresh_in_background, args=(version,), daemon=True
+            )
+            background_refresh.start()
+        logger.info({"status": "serving stale data while refreshing"})
+        metrics.count("cache_hits")
+        return cached
+
+    metrics.count("cache_misses")
+    seen_refreshes = refresh_count
+    with refresh_lock:
+        # the data may have been invalidated again since another request loaded it
+        if refresh_count == seen_refreshes or not todays_data:
+            load_data(version)
+        else:
+            logger.info({"status": "using data loaded by another request"})
+        return todays_data
+
+
+def refresh_in_background(version):
+    try:
+        load_data(version)
+    except Exception as e:
+        logger.error({"error": f"background refresh failed: {e}"})
+    finally:
+        refresh_lock.release()
+
+
+def load_data(version):
+    """
+    Replaces todays_data with current data. Only rows updated since it
+    was loaded are fetched and merged in. The whole data set is reloaded
+    when nothing is cached, after an invalidation, or when the cached
+    rows no longer line up with the tables. Callers must hold refresh_lock
+    """
+    global todays_data, refresh_count
+
+    cached = todays_data
+    refreshed = None
+    if cached:
+        refreshed = merge_updated_rows(cached)
+    if refreshed is None:
+        logger.info({"status": "getting new data"})
+        datasets = get_combined_rows()
+        refreshed = {
+            "datasets": datasets,
+            "max_updated_at": get_max_updated_at(datasets),
+            "payloads": {},
+            "slices": OrderedDict(),
+        }
+        logger.info({"status": "successfully retrieved data"})
+    refreshed["data_version"] = version
+    refreshed["published"] = get_published()
+    refreshed["last_updated"] = str(datetime.utcnow())
+    todays_data = refreshed
+    refresh_count += 1
+
+
+def get_data_version():
+    """
+    Version the ingestion functions bump whenever they write data. It
+    keeps the cache in every warm container in step with the DB instead
+    of only the one that got the invalidate call. It's read at most once
+    every DATA_VERSION_CHECK_SECONDS, so cache hits in between don't
+    wait on the DB, and an unreachable DB costs one connect timeout per
+    interval rather than one per request. Returns None if it can't be
+    read, which leaves expiring the cache to the TTL
+    """
+    global data_version_checked
+    now = time.monotonic()
+    if data_version_checked and now - data_version_checked[0] < DATA_VERSION_CHECK_SECONDS:
+        return data_version_checked[1]
+
+    version = None
+    try:
+        data = db.fetch_data("SELECT version FROM data_version WHERE id = 1;")
+        if data:
+            version = data[0][0]
+    except Exception as e:
+        logger.error({"error": f"unable to read data version: {e}"})
+    data_version_checked = (now, version)
+    return version
+
+
+def get_published():
+    """
+    Last time each data function saved new data, from its invokes rows.
+    Empty if they can't be read
+    """
+    try:
+        data = db.fetch_data(
+            "SELECT function_name, MAX(invoke_time) FROM invokes WHERE new_data GROUP BY function_name;"
+        )
+    except Exception as e:
+        logger.error({"error": f"unable to read publish times: {e}"})
+        return {}
+    return dict(data)
+
+
+def merge_updated_rows(cached):
+    """
+    Fetches rows updated since cached was loaded and returns a copy of it
+    with the rows from the first changed date on replaced. Averages are
+    recomputed from that date on only. Returns None if the row counts
+    don't match the tables afterwards (e.g. rows were deleted), meaning
+    the cache needs a full reload
+    """
+    changes = get_table_changes(cached["max_updated_at"])
+    changed = {table: first for table, (first, _) in changes.items() if first}
+    datasets = dict(cached["datasets"])
+    if changed:
+        since = min(changed.values())
+        fresh = get_daily_rows(list(changed), since=since)
+        for table, rows in fresh.items():
+            daily, ave = TABLE_DATASETS[table]
+            kept = datasets[daily]
+            start = bisect_left([row[0] for row in kept], since)
+            merged = kept[:start] + rows
+            datasets[daily] = merged
+            datasets[ave] = datasets[ave][:start] + weekly_averages(
+                merged, DATASET_COLUMNS[daily], DATASET_COLUMNS[ave], start=start
+            )
+
+    for table, (_, count) in changes.items():
+        daily = TABLE_DATASETS[table][0]
+        if len(datasets[daily]) != count:
+            logger.info({"status": "cached rows out of sync", "table": table})
+            return None
+
+    if not changed:
+        logger.info({"status": "no updated rows"})
+        return dict(cached)
+    logger.info({"status": "merged updated rows", "tables": list(changed)})
+    return {
+        "datasets": datasets,
+        "max_updated_at": get_max_updated_at(datasets),
+        "payloads": {},
+        "slices": OrderedDict(),
+    }
+
+
+def get_table_changes(max_updated_at):
+    """
+    For each table, the first reporting date with a row updated after
+    max_updated_at (None if there isn't one) and the total row count
+    """
+    sql = " UNION ALL ".join(
+        f"""SELECT '{table}', MIN(reporting_date) FILTER (
+            WHERE updated_at > COALESCE(%s, '-infinity'::timestamp)), COUNT(*) FROM {table}"""
+        for table in TABLE_DATASETS
+    )
+    params = [max_updated_at.get(table) for table in TABLE_DATASETS]
+    return {
+        table: (first, count) for table, first, count in db.fetch_data(sql + ";", params)
+    }
+
+
+def get_max_updated_at(datasets):
+    max_updated_at = {}
+    for table, (daily, _) in TABLE_DATASETS.items():
+        index = DATASET_COLUMNS[daily].index("updated_at")
+        max_updated_at[table] = max(
+            (row[index] for row in datasets[daily]), default=None
+        )
+    return max_updated_at
+
+
+def get_data_params(args):
+    """
+    Reads since, until and fields from the query string. Fields are
+    checked against the columns the API already serves. Raises a
+    ValueError with a message for the client when anything is off
+    """
+    since = parse_date(args.get("since"), "since")
+    until = parse_date(args.get("until"), "until")
+    if since and until and since > until:
+        raise ValueError("since must not be after until")
+
+    fields = None
+    columns = DATASET_COLUMNS
+    if args.get("fields"):
+        fields = tuple(sorted({field.strip() for field in args["fields"].split(",")}))
+        unknown = [field for field in fields if field not in KNOWN_COLUMNS]
+        if unknown:
+            raise ValueError(f"unknown fields {', '.join(unknown)}")
+        columns = project_columns(fields)
+        if not columns:
+            raise ValueError("fields must include at least one data column")
+    return since, until, fields, columns
+
+
+def get_series_params(args):
+    """
+    Reads column, points and algorithm for /series/. points is the
+    number of points LTTB keeps; weekly and monthly buckets ignore it
+    """
+    column = args.get("column")
+    if column not in SERIES_COLUMNS:
+        raise ValueError(f"column must be one of {', '.join(SERIES_COLUMNS)}")
+    algorithm = args.get("algorithm", "lttb")
+    if algorithm not in SERIES_ALGORITHMS:
+        raise ValueError(f"algorithm must be one of {', '.join(SERIES_ALGORITHMS)}")
+    try:
+        points = int(args.get("points", SERIES_DEFAULT_POINTS))
+    except ValueError:
+        raise ValueError("points must be a whole number")
+    if not 3 <= points <= SERIES_MAX_POINTS:
+        raise ValueError(f"points must be between 3 and {SERIES_MAX_POINTS}")
+    if algorithm != "lttb":
+        points = None  # so every points value shares one cached payload
+    return column, points, algorithm
+
+
+def parse_date(value, name):
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a date formatted YYYY-MM-DD")
+
+
+def project_columns(fields):
+    """
+    Narrows each data set down to the requested fields, dropping
+    data sets that don't have any of them
+    """
+    columns = {}
+    for name, values in DATASET_COLUMNS.items():
+        projected = [value for value in values[1:] if value in fields]
+        if projected:
+            columns[name] = ["reporting_date"] + projected
+    return columns
+
+
+def get_sliced_payload(cached, response_format, since, until, fields, columns):
+    def build():
+        datasets = slice_datasets(cached["datasets"], columns, since, until)
+        data = format_datasets(datasets, response_format, columns)
+        return build_payload(data, cached["last_updated"])
+
+    return get_cached_slice(cached, (response_format, since, until, fields), build)
+
+
+def get_cached_slice(cached, key, build):
+    """
+    Payload for key from the cached slices, building it with build() on a
+    miss and evicting the least recently used ones past SLICE_CACHE_SIZE
+    """
+    slices = cached["slices"]
+    payload = slices.get(key)
+    if payload:
+        slices.move_to_end(key)
+        return payload
+
+    payload = build()
+    slices[key] = payload
+    while len(slices) > SLICE_CACHE_SIZE:
+        slices.popitem(last=False)
+    return payload
+
+
+def slice_datasets(datasets, columns, since, until):
+    """
+    Cuts the cached data sets down to the date range and fields. The
+    averages were computed over the full history, so they are already
+    correct at the start of the range
+    """
+    sliced = {}
+    for name, values in columns.items():
+        rows = datasets[name]
+        dates = [row[0] for row in rows]
+        start = bisect_left(dates, since) if since else 0
+        end = bisect_right(dates, until) if until else len(rows)
+        indexes = [DATASET_COLUMNS[name].index(value) for value in values]
+        sliced[name] = [tuple(row[i] for i in indexes) for row in rows[start:end]]
+    return sliced
+
+
+def downsample_series(datasets, column, points, algorithm):
+    """
+    Reporting dates and values of one daily column, cut down to points
+    with LTTB or averaged per week (starting Mondays) or month. Missing
+    values are skipped by LTTB and left out of the bucket averages
+    """
+    import numpy as np  # only /series/ needs it, so keep it off the cold start
+
+    name = SERIES_COLUMNS[column]
+    index = DATASET_COLUMNS[name].index(column)
+    rows = datasets[name]
+    dates = np.array([row[0] for row in rows], dtype="datetime64[D]")
+    values = np.array([row[index] for row in rows], dtype=float)
+
+    if algorithm == "lttb":
+        present = ~np.isnan(values)
+        dates, values = dates[present], values[present]
+        keep = lttb_indexes(dates.astype(np.int64).astype(float), values, points)
+        dates, values = dates[keep], values[keep]
+    else:
+        if algorithm == "weekly":
+            days = dates.astype(np.int64)
+            starts = dates - (days + 3) % 7  # 1970-01-01 was a Thursday
+        else:
+            starts = dates.astype("datetime64[M]").astype("datetime64[D]")
+        dates, buckets = np.unique(starts, return_inverse=True)
+        present = ~np.isnan(values)
+        sums = np.bincount(buckets, weights=np.where(present, values, 0), minlength=len(dates))
+        counts = np.bincount(buckets, weights=present, minlength=len(dates))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = np.round(sums / counts, 2)
+
+    return (
+        [str(day) for day in dates.tolist()],
+        [None if np.isnan(value) else value for value in values.tolist()],
+    )
+
+
+def lttb_indexes(x, y, points):
+    """
+    Indexes of the points Largest-Triangle-Three-Buckets keeps. The first
+    and last points always stay; from each bucket in between it keeps the
+    point making the largest triangle with the point kept before it and
+    the average of the next bucket. Bucket averages are computed for all
+    buckets at once, leaving only the inherently sequential pick per
+    bucket as a loop
+    """
+    import numpy as np
+
+    n = len(x)
+    if points >= n:
+        return np.arange(n)
+
+    # floor(i * (n - 2) / (points - 2)) in integers, so float rounding can't move a bucket edge
+    bounds = np.arange(points - 1) * (n - 2) // (points - 2) + 1
+    sizes = np.diff(bounds)
+    # the last bucket ends before the last point, which is kept on its own
+    next_x = np.append(np.add.reduceat(x[:-1], bounds[:-1])[1:] / sizes[1:], x[-1])
+    next_y = np.append(np.add.reduceat(y[:-1], bounds[:-1])[1:] / sizes[1:], y[-1])
+
+    keep = np.empty(points, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    previous = 0
+    for i in range(points - 2):
+        start, end = bounds[i], bounds[i + 1]
+        areas = np.abs(
+            (x[previous] - next_x[i]) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y[i] - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        keep[i + 1] = previous
+    return keep
+
+
+def build_payload(data, last_updated):
+    """
+    Encodes the response once so cache hits only have to pick the
+    right set of bytes. Keeps gzip and brotli variants along with a
+    digest of the encoded data alone for the (weak) ETag. last_updated
+    is when this container loaded it, so hashing the whole body would give
+    the same data a different ETag in every container and after every reload
+    """
+    with metrics.timed("encode"):
+        encoded = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        # same bytes as dumping the whole envelope, without encoding data twice
+        stamp = json.dumps(last_updated).encode("utf-8")
+        body = b'{"data":%s,"last_updated":%s}' % (encoded, stamp)
+        payload = {
+            "identity": body,
+            "gzip": gzip.compress(body, mtime=0),
+            "etag": hashlib.sha256(encoded).hexdigest()[:32],
+            "last_updated": last_updated,
+        }
+        if brotli:
+            payload["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return payload
+
+
+def encoded_response(payload, headers, cached):
+    """
+    Picks the encoding of payload the client accepts, or an empty 304
+    when its If-None-Match ETag is still current. Either way it says how
+    long the response can be cached, going by when cached was published
+    """
+    encoding = choose_encoding(headers.get("accept-encoding"), payload)
+    response_headers = {
+        "ETag": format_etag(payload["etag"], encoding),
+        "Vary": "Accept-Encoding",
+    }
+    response_headers.update(freshness_headers(cached.get("published") or {}))
+    if etag_matches(headers.get("if-none-match"), payload["etag"]):
+        return b"", 304, response_headers
+
+    response_headers["Content-Type"] = "application/json"
+    if encoding != "identity":
+        response_headers["Content-Encoding"] = encoding
+    return payload[encoding], 200, response_headers
+
+
+def freshness_headers(published):
+    """
+    Cache-Control, Expires and Last-Modified for data published by the
+    data functions at the times in published (by function name). The
+    data can't change before the next update window, or, inside the
+    window, until every function has published, so it stays fresh until
+    then. Otherwise it's only good for UPDATE_WINDOW_MAX_AGE
+    """
+    now = datetime.utcnow()
+    window_start = now.replace(hour=UPDATE_WINDOW_START_HOUR, minute=0, second=0, microsecond=0)
+    if window_start > now:
+        window_start -= timedelta(days=1)
+    next_window = window_start + timedelta(days=1)
+
+    in_window = now < window_start + timedelta(hours=UPDATE_WINDOW_HOURS)
+    published_in_window = all(
+        published.get(function) and published[function] >= window_start
+        for function in UPDATE_FUNCTIONS
+    )
+    if in_window and not published_in_window:
+        max_age = UPDATE_WINDOW_MAX_AGE
+    else:
+        max_age = int((next_window - now).total_seconds())
+
+    headers = {
+        "Cache-Control": f"public, max-age={max_age}, stale-while-revalidate={CACHE_CONTROL_SWR}",
+        "Expires": http_date(now + timedelta(seconds=max_age)),
+    }
+    if published:
+        headers["Last-Modified"] = http_date(max(published.values()))
+    return headers
+
+
+def http_date(value):
+    return format_datetime(value.replace(tzinfo=timezone.utc), usegmt=True)
+
+
+def format_etag(digest, encoding):
+    """
+    Each content coding is a different representation, so it gets its
+    own ETag. They're weak because the digest only covers the data, not
+    the last_updated the body also carries, which differs between
+    containers and reloads
+    """
+    if encoding == "identity":
+        return f'W/"{digest}"'
+    return f'W/"{digest}-{encoding}"'
+
+
+def etag_matches(if_none_match, digest):
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag.strip('"').split("-")[0] == digest:
+            return True
+    return False
+
+
+def choose_encoding(accept_encoding, payload):
+    """
+    Picks brotli, then gzip, then no compression based on what the
+    client accepts. Codings with q=0 are treated as refused
+    """
+    accepted = set()
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+
+    for encoding in ["br", "gzip"]:
+        if encoding in payload and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+
+def range_conditions(since, until):
+    conditions = []
+    params = []
+    if since:
+        conditions.append("reporting_date >= %s")
+        params.append(since)
+    if until:
+        conditions.append("reporting_date <= %s")
+        params.append(until)
+    return conditions, params
+
+
+def where_sql(conditions):
+    if not conditions:
+        return ""
+    return f' WHERE {" AND ".join(conditions)}'
+
+
+def format_data(data, values):
+    formatted_data = []
+    for entry in data:
+        new_data = {}
+        for i, value in enumerate(values):
+            new_data[value] = entry[i]
+            if value == "reporting_date":
+                new_data[value] = str(entry[i])
+            elif value in TIME_COLUMNS:
+                new_data[value] = str(entry[i] - timedelta(hours=7))  # convert to MST
+            elif isinstance(entry[i], decimal.Decimal):
+                new_data[value] = round(
+                    float(entry[i]), 2
+                )  # psycopg2 returns Decimal, which fails at json.dumps
+        formatted_data.append(new_data)
+    return formatted_data
+
+
+def format_columnar(data, values):
+    """
+    One list per column instead of one dict per day, so column names
+    aren't repeated for every row. reporting_date is the shared axis
+    the other columns line up with
+    """
+    columns = zip(*data) if data else [[] for _ in values]
+    formatted_data = {}
+    for value, column in zip(values, columns):
+        if value == "reporting_date":
+            formatted_data[value] = [str(entry) for entry in column]
+        elif value in TIME_COLUMNS:
+            mst = timedelta(hours=7)
+            formatted_data[value] = [str(entry - mst) for entry in column]
+        else:
+            formatted_data[value] = [
+                round(float(entry), 2) if isinstance(entry, decimal.Decimal) else entry
+                for entry in column
+            ]
+    return formatted_data
+
+
+RESPONSE_FORMATS = {"rows": format_data, "columnar": format_columnar}
+
+
+def get_combined_rows():
+    """
+    Fetches daily rows for cases and vaccines in one query on a single
+    connection and derives the weekly rolling averages from them in
+    process rather than running the window in Postgres
+    """
+    daily_rows = get_daily_rows(list(TABLE_DATASETS))
+    datasets = {}
+    for table, (daily, ave) in TABLE_DATASETS.items():
+        datasets[daily] = daily_rows[table]
+        datasets[ave] = weekly_averages(
+            daily_rows[table], DATASET_COLUMNS[daily], DATASET_COLUMNS[ave]
+        )
+    return datasets
+
+
+def get_daily_rows(tables, since=None):
+    """
+    Daily rows for each table, starting at since if given. The tables
+    are read in their own CTEs and joined on reporting_date so it only
+    takes one query
+    """
+    ctes = []
+    params = []
+    widths = []
+    for table in tables:
+        values = DATASET_COLUMNS[TABLE_DATASETS[table][0]]
+        conditions, table_params = range_conditions(since, None)
+        ctes.append(
+            f'{table}_data AS (SELECT {", ".join(values)} FROM {table}{where_sql(conditions)})'
+        )
+        params += table_params
+        widths.append(len(values))
+
+    aliases = [f"{table}_data" for table in tables]
+    from_sql = aliases[0]
+    for i, alias in enumerate(aliases[1:], 1):
+        joined_dates = ", ".join(f"{joined}.reporting_date" for joined in aliases[:i])
+        from_sql += f" FULL OUTER JOIN {alias} ON {alias}.reporting_date = COALESCE({joined_dates})"
+    sql = f"""
+        WITH {", ".join(ctes)}
+        SELECT {", ".join(f"{alias}.*" for alias in aliases)} FROM {from_sql}
+        ORDER BY COALESCE({", ".join(f"{alias}.reporting_date" for alias in aliases)}) ASC;
+    """
+    data = db.fetch_data(sql, params)
+
+    daily_rows = {}
+    offset = 0
+    for table, width in zip(tables, widths):
+        # skip dates only the other tables have
+        daily_rows[table] = [
+            row[offset : offset + width] for row in data if row[offset] is not None
+        ]
+        offset += width
+    return daily_rows
+
+
+def weekly_averages(daily_rows, daily_values, ave_values, start=0):
+    """
+    Weekly rolling averages of daily_rows from row start on, matching
+    ROUND(AVG(value) OVER (ROWS BETWEEN 6 PRECEDING AND CURRENT ROW)).
+    Like AVG, NULLs are left out of the window and a window of only
+    NULLs averages to NULL. Uses running sums so it's O(n) however
+    many rows there are
+    """
+    indexes = [daily_values.index(value) for value in ave_values[1:]]
+    window = WINDOW_PRECEDING_ROWS + 1
+    sums = [0] * len(indexes)
+    counts = [0] * len(indexes)
+    first = max(0, start - WINDOW_PRECEDING_ROWS)
+
+    ave_rows = []
+    for i in range(first, len(daily_rows)):
+        row = daily_rows[i]
+        for j, index in enumerate(indexes):
+            if row[index] is not None:
+                sums[j] += row[index]
+                counts[j] += 1
+        if i - window >= first:
+            dropped = daily_rows[i - window]
+            for j, index in enumerate(indexes):
+                if dropped[index] is not None:
+                    sums[j] -= dropped[index]
+                    counts[j] -= 1
+        if i >= start:
+            ave_rows.append(
+                (row[0],) + tuple(map(round_average, sums, counts))
+            )
+    return ave_rows
+
+
+def round_average(total, count):
+    """
+    Rounds total / count half away from zero like ROUND(numeric) does,
+    using integer math so no precision is lost along the way
+    """
+    if not count:
+        return None
+    rounded = (2 * abs(total) + count) // (2 * count)
+    return decimal.Decimal(rounded if total >= 0 else -rounded)
+
+
+def format_datasets(datasets, response_format, columns=DATASET_COLUMNS):
+    formatter = RESPONSE_FORMATS[response_format]
+    with metrics.timed("format"):
+        return {name: formatter(rows, columns[name]) for name, rows in datasets.items()}
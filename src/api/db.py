@@ -0,0 +1,169 @@
+"""
+Postgres connections kept open across warm Lambda invocations. Opening a
+connection (TCP + TLS + auth) costs more than the queries the API runs,
+so idle connections are parked here and handed back out on the next
+request as long as they still look healthy
+"""
+import os
+import time
+import logging
+import threading
+
+import psycopg2
+from psycopg2 import extensions
+
+try:
+    from . import metrics
+except ImportError:  # Lambda loads src/api/ as top level modules
+    import metrics
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DB_CREDENTIALS = os.getenv("DB_CREDENTIALS")
+if not DB_CREDENTIALS:
+    logger.error({"error": "no DB credentials found"})
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "2"))
+MAX_IDLE_SECONDS = int(os.getenv("DB_MAX_IDLE_SECONDS", "300"))
+# well under the function timeout, so an unreachable DB fails fast and the cache can answer
+CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT_SECONDS", "3"))
+
+# errors that mean the connection itself is gone rather than the query being bad
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+idle_connections = []  # (connection, time it was released)
+pool_lock = threading.Lock()
+pool_stats = {"hits": 0, "misses": 0, "stale": 0, "reconnects": 0}
+
+
+def checkout():
+    """
+    Returns a connection and whether it came from the pool. Idle
+    connections that are closed, broken or past the max idle age
+    are thrown away instead of being handed out
+    """
+    while True:
+        with pool_lock:
+            if not idle_connections:
+                break
+            conn, released_at = idle_connections.pop()
+        if is_healthy(conn, released_at):
+            pool_stats["hits"] += 1
+            return conn, True
+        pool_stats["stale"] += 1
+        close_quietly(conn)
+
+    pool_stats["misses"] += 1
+    logger.info({"status": "opening new db connection", "pool": pool_stats})
+    with metrics.timed("db_connect"):
+        conn = psycopg2.connect(DB_CREDENTIALS, connect_timeout=CONNECT_TIMEOUT)
+    conn.autocommit = True  # API only reads, so skip the BEGIN/ROLLBACK round trips
+    return conn, False
+
+
+def release(conn):
+    if conn.closed or conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+        close_quietly(conn)
+        return
+    with pool_lock:
+        if len(idle_connections) < POOL_SIZE:
+            idle_connections.append((conn, time.monotonic()))
+            return
+    close_quietly(conn)
+
+
+def is_healthy(conn, released_at):
+    if conn.closed:
+        return False
+    if time.monotonic() - released_at > MAX_IDLE_SECONDS:
+        return False
+    try:
+        conn.poll()  # picks up a server side disconnect without a round trip
+    except psycopg2.Error:
+        return False
+    return True
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def clear_pool():
+    with pool_lock:
+        connections = [conn for conn, _ in idle_connections]
+        idle_connections.clear()
+    for conn in connections:
+        close_quietly(conn)
+
+
+def run_query(query):
+    """
+    Runs query(cursor) on a pooled connection. If the pooled connection
+    went stale since the health check, reconnect and run it once more
+    """
+    conn, reused = checkout()
+    try:
+        with metrics.timed("db_query"):
+            result = query(conn.cursor())
+    except CONNECTION_ERRORS:
+        close_quietly(conn)
+        if not reused:
+            raise
+        pool_stats["reconnects"] += 1
+        logger.info({"status": "pooled db connection went stale, reconnecting"})
+        conn, _ = checkout()
+        try:
+            with metrics.timed("db_query"):
+                result = query(conn.cursor())
+        except Exception:
+            close_quietly(conn)
+            raise
+    except Exception:
+        release(conn)
+        raise
+    release(conn)
+    return result
+
+
+def fetch_data(sql, params=None):
+    def query(cur):
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+    return run_query(query)
+
+
+def stream_data(sql, params=None, chunk_size=500):
+    """
+    Yields the result in lists of up to chunk_size rows read from a
+    server side (named) cursor, so only one chunk is in memory at a
+    time however big the result is. If the caller stops early the
+    connection is closed rather than going back to the pool mid
+    transaction
+    """
+    conn, _ = checkout()
+    finished = False
+    try:
+        conn.autocommit = False  # named cursors only exist inside a transaction
+        cur = conn.cursor(name="stream_data")
+        cur.itersize = chunk_size
+        with metrics.timed("db_query"):
+            cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+        cur.close()
+        conn.rollback()
+        conn.autocommit = True
+        finished = True
+    finally:
+        if finished:
+            release(conn)
+        else:
+            close_quietly(conn)
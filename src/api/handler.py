@@ -0,0 +1,127 @@
+"""
+Lambda handler that answers API Gateway proxy events directly instead
+of going through FlaskLambda, WSGI and Flask routing. It only imports
+core, so Flask and flask_cors never load on a cold start. Serves the
+same routes with the same CORS headers as app.app and can be swapped in
+as the function's Handler (handler.handler)
+"""
+import base64
+import logging
+
+try:
+    from . import core, metrics
+except ImportError:  # Lambda loads src/api/ as top level modules
+    import core
+    import metrics
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# the methods flask_cors allows in preflight responses by default
+CORS_METHODS = "DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"
+
+
+def get_data(args, headers):
+    return core.data_response(args, headers)
+
+
+def get_series(args, headers):
+    return core.series_response(args, headers)
+
+
+def get_metrics(args, headers):
+    return core.metrics_response()
+
+
+def get_health(args, headers):
+    return core.health_response()
+
+
+def export_data(table):
+    def export(args, headers):
+        return core.export_response(table, args)
+
+    return export
+
+
+def invalidate_cache(args, headers):
+    return core.invalidate_cache(headers.get("invalidate-cache-key"))
+
+
+ROUTES = {
+    "/data/": (["GET", "HEAD"], get_data),
+    "/series/": (["GET", "HEAD"], get_series),
+    "/metrics/": (["GET", "HEAD"], get_metrics),
+    "/health/": (["GET", "HEAD"], get_health),
+    "/invalidate_cache/": (["POST"], invalidate_cache),
+}
+ROUTES.update(
+    {f"/export/{table}": (["GET", "HEAD"], export_data(table)) for table in core.TABLE_DATASETS}
+)
+
+
+def handler(event, context):
+    metrics.start_request()
+    headers = {name.lower(): value for name, value in (event.get("headers") or {}).items()}
+    args = event.get("queryStringParameters") or {}
+    method = event["httpMethod"]
+
+    route = ROUTES.get(event["path"])
+    if not route:
+        body, status, response_headers = core.json_response({"error": "not found"}, 404)
+    elif method == "OPTIONS":
+        body, status, response_headers = preflight_response(route[0], headers)
+    elif method not in route[0]:
+        body, status, response_headers = core.json_response({"error": "method not allowed"}, 405)
+        response_headers["Allow"] = ", ".join(route[0] + ["OPTIONS"])
+    else:
+        try:
+            body, status, response_headers = route[1](args, headers)
+            if method == "HEAD":
+                body = b""
+            elif not isinstance(body, bytes):
+                # API Gateway can't stream, so exports are collected here
+                body = b"".join(body)
+        except Exception as e:
+            logger.error({"error": f"unable to handle {method} {event['path']}: {e}"})
+            body, status, response_headers = core.json_response(
+                {"error": "internal server error"}, 500
+            )
+
+    add_cors_headers(response_headers, headers.get("origin"))
+    metrics.finish_request(event["path"] if route else "unmatched")
+    return lambda_response(body, status, response_headers)
+
+
+def preflight_response(methods, headers):
+    response_headers = {"Allow": ", ".join(methods + ["OPTIONS"])}
+    if headers.get("access-control-request-method"):
+        response_headers["Access-Control-Allow-Methods"] = CORS_METHODS
+        if headers.get("access-control-request-headers"):
+            response_headers["Access-Control-Allow-Headers"] = headers[
+                "access-control-request-headers"
+            ]
+    return b"", 200, response_headers
+
+
+def add_cors_headers(response_headers, origin):
+    """
+    Same as flask_cors with its defaults: any origin is allowed, and when
+    the request names one it's echoed back so the response varies by it
+    """
+    if not origin:
+        response_headers["Access-Control-Allow-Origin"] = "*"
+        return
+    response_headers["Access-Control-Allow-Origin"] = origin
+    vary = response_headers.get("Vary")
+    response_headers["Vary"] = f"{vary}, Origin" if vary else "Origin"
+
+
+def lambda_response(body, status, response_headers):
+    response = {"statusCode": status, "headers": response_headers}
+    if response_headers.get("Content-Encoding"):
+        response["body"] = base64.b64encode(body).decode("ascii")
+        response["isBase64Encoded"] = True
+    else:
+        response["body"] = body.decode("utf-8")
+    return response
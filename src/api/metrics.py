@@ -0,0 +1,112 @@
+"""
+Request timings split into phases (DB connect, query, formatting,
+encoding) and cache hit counts. Every request logs its timings as a
+CloudWatch embedded metric format (EMF) line, and the last METRICS_WINDOW
+samples per phase are kept in memory for /metrics/. Recording is an
+append to a bounded deque, so it's cheap enough to leave on
+"""
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1024"))
+EMIT_EMF = os.getenv("EMIT_EMF_METRICS", "true").lower() == "true"
+EMF_NAMESPACE = "ColoradoCovid/API"
+
+samples = {}  # phase: recent durations in ms
+counters = {"cache_hits": 0, "cache_misses": 0}
+current = threading.local()  # phases timed for the request on this thread
+
+
+def start_request():
+    current.phases = {}
+    current.started = time.perf_counter()
+
+
+def finish_request(route):
+    """
+    Records the total time of the request started on this thread and
+    logs its phases as an EMF line
+    """
+    phases = getattr(current, "phases", None)
+    if phases is None:
+        return
+    record("total", (time.perf_counter() - current.started) * 1000)
+    current.phases = None
+    if EMIT_EMF:
+        print(json.dumps(emf_line(route, phases)))
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, (time.perf_counter() - start) * 1000)
+
+
+def record(phase, duration):
+    durations = samples.get(phase)
+    if durations is None:
+        durations = samples.setdefault(phase, deque(maxlen=METRICS_WINDOW))
+    durations.append(duration)
+    phases = getattr(current, "phases", None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0) + duration
+
+
+def count(counter):
+    counters[counter] += 1
+
+
+def emf_line(route, phases):
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": EMF_NAMESPACE,
+                    "Dimensions": [["Route"]],
+                    "Metrics": [{"Name": phase, "Unit": "Milliseconds"} for phase in phases],
+                }
+            ],
+        },
+        "Route": route,
+        **{phase: round(duration, 3) for phase, duration in phases.items()},
+    }
+
+
+def summary():
+    """
+    p50/p95/p99 in ms of the recent samples of each phase, and the
+    share of requests served from cached data
+    """
+    phases = {}
+    for phase, durations in list(samples.items()):
+        ordered = sorted(durations)
+        phases[phase] = {"count": len(ordered)}
+        for pct in [50, 95, 99]:
+            phases[phase][f"p{pct}"] = round(percentile(ordered, pct), 3)
+    requests = counters["cache_hits"] + counters["cache_misses"]
+    return {
+        "phases": phases,
+        "cache": {
+            **counters,
+            "hit_ratio": round(counters["cache_hits"] / requests, 4) if requests else None,
+        },
+    }
+
+
+def percentile(ordered, pct):
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def reset():
+    samples.clear()
+    for counter in counters:
+        counters[counter] = 0
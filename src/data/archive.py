@@ -0,0 +1,122 @@
+"""
+Raw and cleaned data archived in S3 as gzipped JSON named by the sha256
+of the content, with a manifest of which content each day had. Content
+that's already in the archive isn't uploaded again, and a day whose
+content matches the day before is a cheap sign nothing changed.
+Downloads are compressed and hashed as they stream in, so the bytes the
+state served are archived as they were
+"""
+import gzip
+import json
+import hashlib
+import logging
+import tempfile
+from datetime import datetime, timedelta
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# S3 prefixes of each data set's raw and cleaned archives
+PREFIXES = {
+    "cases": ("data/raw_case_data", "data/clean_case_data"),
+    "vaccines": ("data/raw_vaccine_data", "data/clean_vaccine_data"),
+}
+
+
+class ArchiveFile:
+    """
+    Write only file that gzips what's written to it into a temporary
+    file, hashing it uncompressed on the way
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.compressed = gzip.GzipFile(fileobj=self.file, mode="wb", mtime=0)
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.compressed.write(data)
+
+    def close(self):
+        self.compressed.close()
+        self.file.close()
+
+
+def archive_json(data):
+    """An ArchiveFile of data encoded as JSON, for data that wasn't downloaded as is"""
+    archive_file = ArchiveFile()
+    archive_file.write(json.dumps(data).encode("utf-8"))
+    return archive_file
+
+
+def save_archive(s3_client, bucket, prefix, archive_file):
+    """save() for today, noting when the content is the same as last time"""
+    key, changed = save(s3_client, bucket, prefix, archive_file)
+    if not changed:
+        logger.info(f"s3://{bucket}/{key} is the same as the last archive")
+
+
+def today():
+    return (datetime.utcnow() - timedelta(hours=7)).strftime("%Y-%m-%d")
+
+
+def save(s3_client, bucket, prefix, archive_file, day=None):
+    """
+    Uploads archive_file to prefix/<sha256>.json.gz unless that content is
+    already archived, and records it as day's (today by default) content
+    in prefix/manifest.json. Returns the key and whether the content
+    differs from the last day before it in the manifest
+    """
+    day = day or today()
+    digest = archive_file.hash.hexdigest()
+    key = f"{prefix}/{digest}.json.gz"
+    try:
+        manifest = get_manifest(s3_client, bucket, prefix)
+        earlier = [archived for archived in sorted(manifest) if archived < day]
+        changed = not earlier or manifest[earlier[-1]] != digest
+
+        if digest in manifest.values():
+            logger.info(f"s3://{bucket}/{key} is already archived, skipping upload")
+        else:
+            archive_file.compressed.close()  # writes the gzip trailer
+            archive_file.file.seek(0)
+            s3_client.upload_fileobj(
+                archive_file.file,
+                bucket,
+                key,
+                ExtraArgs={"ContentType": "application/json", "ContentEncoding": "gzip"},
+            )
+            logger.info(f"Archived {archive_file.size} bytes to s3://{bucket}/{key}")
+
+        if manifest.get(day) != digest:
+            manifest[day] = digest
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=f"{prefix}/manifest.json",
+                Body=json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+                ContentType="application/json",
+            )
+    finally:
+        archive_file.close()
+    return key, changed
+
+
+def get_manifest(s3_client, bucket, prefix):
+    """Day: sha256 of the content archived that day, empty before the first archive"""
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=f"{prefix}/manifest.json")
+    except s3_client.exceptions.NoSuchKey:
+        return {}
+    return json.loads(response["Body"].read())
+
+
+def load(s3_client, bucket, prefix, day):
+    """The content archived on day, decompressed, or None if there isn't any"""
+    digest = get_manifest(s3_client, bucket, prefix).get(day)
+    if not digest:
+        return None
+    response = s3_client.get_object(Bucket=bucket, Key=f"{prefix}/{digest}.json.gz")
+    return gzip.decompress(response["Body"].read())
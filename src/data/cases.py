@@ -1,12 +1,17 @@
 import os
-import io
 from datetime import datetime, timedelta
-import json
 import logging
 
 import requests
 import boto3
-import psycopg2
+
+try:
+    from . import archive, db, fetch, increases
+except ImportError:  # Lambda loads src/data/ as top level modules
+    import archive
+    import db
+    import fetch
+    import increases
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -15,18 +20,26 @@ logger.setLevel(logging.INFO)
 BUCKET = os.getenv("S3_BUCKET")
 if not BUCKET:
     logger.error({"error": "no bucket env var found"})
-DB_CREDENTIALS = os.getenv("DB_CREDENTIALS")
-if not DB_CREDENTIALS:
-    logger.error({"error": "no DB credentials env var found"})
 API_URL = (
     "https://opendata.arcgis.com/datasets/80193066bcb84a39893fbed995fc8ed0_0.geojson"
 )
+# FeatureServer layer behind API_URL. When set, polls only ask it whether the next
+# day is in yet and only pull the days and fields cleaning uses
+LAYER_URL = os.getenv("CASES_LAYER_URL")
+LAYER_FIELDS = ["Date", "Cases", "Tested", "Deaths", "Hosp"]
+# most days one layer query asks for, keeping its where clause short enough for a GET.
+# After a longer outage each run catches up this many days
+LAYER_MAX_DAYS = 60
+# days before the first new one that are cleaned and saved again, picking up
+# revisions the state makes to recent counts. Anything older is skipped
+REVISION_DAYS = int(os.getenv("REVISION_DAYS", "14"))
 # following two keys aren't required to function, but if not included then the function
-# won't invalidate the cache as soon as new data is available, but it still
-# will every 15 minutes per the normal schedule
+# won't invalidate the cache of the container it reaches right away. API containers
+# still pick up new data through the data_version row bumped on every write
 INVALIDATE_CACHE_KEY = os.getenv("INVALIDATE_CACHE_KEY")
 API_GATEWAY_URL = os.getenv("API_URL")
 EMAIL_TOPIC = os.getenv("EMAIL_TOPIC")
+RAW_PREFIX, CLEAN_PREFIX = archive.PREFIXES["cases"]
 
 s3_client = boto3.client("s3")
 sns_client = boto3.client("sns")
@@ -34,38 +47,48 @@ sns_client = boto3.client("sns")
 
 def handler(event=None, context=None):
     try:
-        if already_saved_todays_data():
-            logger.info("Data already grabbed for the day")
-            return "Success"
-
-        logger.info("Requesting raw data")
-        raw_data = get_raw_case_data()
-
-        if next_day() in str(raw_data):
-            s3_filename = raw_s3_filename()
-            logger.info(f"New data found. Saving to s3://{BUCKET}/{s3_filename}")
-            save_to_s3(raw_data, s3_filename)
-
-            logger.info("Cleaning data")
-            clean_data = clean_cases_data(raw_data)
-
-            s3_filename = clean_s3_filename()
-            logger.info(f"Saving cleaned data to s3://{BUCKET}/{s3_filename}")
-            save_to_s3(clean_data, s3_filename)
-
-            logger.info("Saving to database")
-            save_case_data_to_db(clean_data)
-            log_update_time(new_data=True)
-
-            update_currently_hospitalized()
+        with db.session():
+            if already_saved_todays_data():
+                logger.info("Data already grabbed for the day")
+                return "Success"
+
+            logger.info("Requesting raw data")
+            raw_data, raw_archive = get_raw_case_data()
+            new_dates = get_new_dates(raw_data) if raw_data else []
+
+            if new_dates:
+                logger.info(
+                    f"New data found for {format_day(new_dates[0])} to "
+                    f"{format_day(new_dates[-1])}. Archiving to s3://{BUCKET}/{RAW_PREFIX}"
+                )
+                archive.save_archive(s3_client, BUCKET, RAW_PREFIX, raw_archive)
+
+                logger.info("Cleaning data")
+                since = new_dates[0] - timedelta(days=REVISION_DAYS)
+                clean_data = clean_cases_data(raw_data, since=since)
+
+                logger.info(f"Archiving cleaned data to s3://{BUCKET}/{CLEAN_PREFIX}")
+                clean_archive = archive.archive_json(clean_data)
+                archive.save_archive(s3_client, BUCKET, CLEAN_PREFIX, clean_archive)
+
+                logger.info("Saving to database")
+                save_case_data_to_db(clean_data)
+            else:
+                logger.info("Data not updated yet")
+                if raw_archive:
+                    raw_archive.close()
+            log_update_time(new_data=bool(new_dates))
+
+        if new_dates:
+            # separately, so a failed scrape can't undo the day's data
+            with db.session():
+                update_currently_hospitalized()
 
             logger.info("Success")
             invalidate_cache()
-        else:
-            logger.info("Data not updated yet")
-            log_update_time(new_data=False)
         return "Success"
     except Exception as e:
+        fetch.forget(API_URL)
         message = f"Encountered an error during Cases data fetching: {f}"
         topic = "ColoradoCovidData Error - Cases"
         sns_client.publish(
@@ -79,15 +102,13 @@ def handler(event=None, context=None):
 
 def already_saved_todays_data():
     """Check if last successful data save was less than 12 hrs ago"""
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
+    cur = db.cursor()
     time_to_check = twelve_hours_ago()
     cur.execute(
         "SELECT * FROM invokes WHERE function_name = %s and invoke_time > %s and new_data = %s",
         ("cases", time_to_check, True),
     )
     data = cur.fetchone()
-    conn.close()
     if data:
         return True
     return False
@@ -105,24 +126,36 @@ def invalidate_cache():
 
 def log_update_time(new_data=False):
     """Update DB with times we checked for new data along with status of if we found new data"""
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute(
         "INSERT INTO invokes (function_name, invoke_time, new_data) VALUES (%s, now(), %s)",
         ("cases", new_data),
     )
-    conn.commit()
-    conn.close()
 
 
-def save_case_data_to_db(clean_data):
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
+CASES_COLUMNS = [
+    "reporting_date",
+    "positive",
+    "total_hospitalized",
+    "death_confirmed",
+    "positive_increase",
+    "death_increase",
+    "hospitalized_increase",
+    "tested",
+    "tested_increase",
+]
 
-    i = 0
-    for day in clean_data:
-        i += 1
-        sql_data = (
+
+def save_case_data_to_db(clean_data):
+    """
+    Upserts the days that are new or changed since they were last saved,
+    along with the data version bump. The handler's session commits them
+    with the run's invokes row, so the API never sees half of a day's
+    update. Unchanged days aren't touched, keeping their updated_at and
+    leaving no dead tuples behind
+    """
+    rows = [
+        (
             day["reporting_date"],
             day["positive"],
             day["hospitalizations"],
@@ -133,31 +166,59 @@ def save_case_data_to_db(clean_data):
             day["tested"],
             day["tested_increase"],
         )
+        for day in clean_data
+    ]
 
-        sql_vars = sql_data + sql_data + (day["reporting_date"],)
-
-        sql = """
-            INSERT INTO cases (reporting_date, positive, total_hospitalized, death_confirmed, 
-            positive_increase, death_increase, hospitalized_increase, tested, tested_increase)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (reporting_date) DO UPDATE SET
-            reporting_date = %s, positive = %s, total_hospitalized = %s, death_confirmed = %s,
-            positive_increase = %s, death_increase = %s, hospitalized_increase = %s, tested = %s,
-            tested_increase = %s WHERE cases.reporting_date = %s;
-        """
-
-        cur.execute(sql, sql_vars)
-        if i % 25 == 0:
-            conn.commit()
-    conn.commit()
-    conn.close()
-
-
-def clean_cases_data(raw_data):
+    cur = db.cursor()
+    fingerprints = db.fetch_fingerprints(cur, "cases", CASES_COLUMNS)
+    rows, summary = db.changed_rows(rows, fingerprints, CASES_COLUMNS)
+    if not rows:
+        logger.info(f"No case data changes: {summary}")
+        return {"inserted": 0, "updated": 0}
+    logger.info(f"Case data changes from {rows[0][0]} to {rows[-1][0]}: {summary}")
+    counts = db.upsert_rows(cur, "cases", CASES_COLUMNS, rows)
+    db.bump_data_version(cur)
+    logger.info(f"Saved case data: {counts['inserted']} inserted, {counts['updated']} updated")
+    return counts
+
+
+# (cumulative column, increase column) for each count cleaning works out
+CASES_INCREASES = [
+    ("positive", "positive_increase"),
+    ("death_confirmed", "death_increase"),
+    ("hospitalizations", "hospitalized_increase"),
+    ("tested", "tested_increase"),
+]
+
+
+def get_new_dates(raw_data):
+    """
+    Days in raw_data after the last one saved, oldest first, going by an
+    index of the features' Date values only
+    """
+    index = {day["properties"]["Date"] for day in raw_data["features"]}
+    first = fetch_latest_day_data()["reporting_date"] + timedelta(days=1)
+    return fetch.dates_from(index, first)
+
+
+def clean_cases_data(raw_data, since=None):
+    """
+    Cleans the days from since on, or every day if it's None. The day
+    before since is only used for the first day's increases
+    """
     daily_data = raw_data["features"]
     data = extract_relevant_data(daily_data)
     sorted_data = sorted(data, key=lambda day: day["reporting_date"])
-    cleaned_data = add_metric_increases(sorted_data)
-    return cleaned_data
+    if since is None:
+        return increases.add_increases(sorted_data, CASES_INCREASES)
+
+    since = since.isoformat()
+    first = next(
+        (i for i, day in enumerate(sorted_data) if day["reporting_date"] >= since),
+        len(sorted_data),
+    )
+    cleaned_data = increases.add_increases(sorted_data[max(first - 1, 0) :], CASES_INCREASES)
+    return [day for day in cleaned_data if day["reporting_date"] >= since]
 
 
 def extract_relevant_data(daily_data):
@@ -177,46 +238,47 @@ def extract_relevant_data(daily_data):
     return relevant_data
 
 
-def add_metric_increases(sorted_data):
-    total_days = len(sorted_data)
-    for i in range(total_days):
-        if i == 0:
-            sorted_data[i]["positive_increase"] = sorted_data[i]["positive"]
-            sorted_data[i]["death_increase"] = sorted_data[i]["death_confirmed"]
-            sorted_data[i]["hospitalized_increase"] = sorted_data[i]["hospitalizations"]
-            sorted_data[i]["tested_increase"] = sorted_data[i]["tested"]
-        else:
-            sorted_data[i]["positive_increase"] = (
-                sorted_data[i]["positive"] - sorted_data[i - 1]["positive"]
-            )
-            sorted_data[i]["death_increase"] = (
-                sorted_data[i]["death_confirmed"]
-                - sorted_data[i - 1]["death_confirmed"]
-            )
-            sorted_data[i]["hospitalized_increase"] = (
-                sorted_data[i]["hospitalizations"]
-                - sorted_data[i - 1]["hospitalizations"]
-            )
-            sorted_data[i]["tested_increase"] = (
-                sorted_data[i]["tested"] - sorted_data[i - 1]["tested"]
-            )
-    return sorted_data
-
-
 def reporting_date_to_formatted(date):
     date_time = datetime.strptime(date, "%m/%d/%Y")
     return date_time.strftime("%Y-%m-%d")
 
 
 def get_raw_case_data():
-    res = requests.get(API_URL)
-    return res.json()
-
-
-def save_to_s3(json_data, s3_filename):
-    data = json.dumps(json_data).encode("utf-8")
-    raw_data = io.BytesIO(data)
-    s3_client.upload_fileobj(raw_data, BUCKET, s3_filename)
+    """
+    The feature collection and an archive of it as it was downloaded, or
+    Nones if the source is unchanged or doesn't have the next day yet
+    """
+    if not LAYER_URL:
+        response = fetch.open_geojson(API_URL)
+        if response is None:
+            return None, None
+        raw_archive = archive.ArchiveFile()
+        try:
+            with response:
+                features = list(fetch.iter_features(response, raw_archive))
+        except Exception:
+            raw_archive.close()
+            raise
+        return {"features": features}, raw_archive
+    new_day = next_day()
+    if not fetch.count_features(LAYER_URL, f"Date = '{new_day}'"):
+        return None, None
+    dates = ", ".join(f"'{day}'" for day in layer_dates(fetch.parse_date(new_day)))
+    raw_data = fetch.query_features(LAYER_URL, f"Date IN ({dates})", LAYER_FIELDS, order_by="Date")
+    return raw_data, archive.archive_json(raw_data)
+
+
+def layer_dates(new_day):
+    """
+    Days cleaning needs from the layer: the REVISION_DAYS before new_day
+    and the one before them for increases, then new_day up to today.
+    Date is a MM/DD/YYYY string, which doesn't sort by date, so they're
+    listed one by one rather than queried as a range
+    """
+    start = new_day - timedelta(days=REVISION_DAYS + 1)
+    today = (datetime.utcnow() - timedelta(hours=7)).date()
+    days = min((max(new_day, today) - start).days, LAYER_MAX_DAYS)
+    return [format_day(start + timedelta(days=i)) for i in range(days + 1)]
 
 
 def format_day(date):
@@ -239,11 +301,9 @@ def week_before():
 
 def fetch_latest_day_data():
     sql = "SELECT * FROM cases ORDER BY reporting_date DESC LIMIT 1;"
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute(sql)
     data = cur.fetchone()
-    conn.close()
 
     if data:
         return {
@@ -251,20 +311,10 @@ def fetch_latest_day_data():
         }
     else:
         return {
-            "reporting_date": week_before,
+            "reporting_date": week_before().date(),
         }
 
 
-def raw_s3_filename():
-    today = datetime.today() - timedelta(hours=7)
-    return f"data/raw_case_data/{today.strftime('%Y%m%d')}.json"
-
-
-def clean_s3_filename():
-    today = datetime.today() - timedelta(hours=7)
-    return f"data/clean_case_data/{today.strftime('%Y%m%d')}.json"
-
-
 def update_currently_hospitalized():
     # for some reason this stat isn't included in the API
     # and I can only find it on the website, so need to scrape
@@ -308,10 +358,7 @@ def get_currently_hospitalized():
 def save_currently_hospitalized(value):
     last_day = fetch_latest_day_data()["reporting_date"]
 
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
-
-    sql = "UPDATE cases SET hospitalized_currently = %s WHERE reporting_date = %s;"
+    cur = db.cursor()
+    sql = "UPDATE cases SET hospitalized_currently = %s, updated_at = now() WHERE reporting_date = %s;"
     cur.execute(sql, (value, last_day))
-    conn.commit()
-    conn.close()
+    db.bump_data_version(cur)
@@ -7,16 +7,15 @@ from datetime import datetime, timedelta
 import logging
 
 import boto3
-import psycopg2
+
+try:
+    from . import db
+except ImportError:  # Lambda loads src/data/ as top level modules
+    import db
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-
-DB_CREDENTIALS = os.getenv("DB_CREDENTIALS")
-if not DB_CREDENTIALS:
-    logger.error({"error": "no DB credentials env var found"})
-
 EMAIL_TOPIC = os.getenv("EMAIL_TOPIC")
 if not EMAIL_TOPIC:
     logger.error({"error": "no SNS Topic credentials env var found"})
@@ -27,8 +26,9 @@ def handler(event=None, context=None):
     """
     Check if the database is up to date
     """
-    latest_day_cases = fetch_latest_day_data("cases")
-    latest_day_vaccines = fetch_latest_day_data("vaccines")
+    with db.session():
+        latest_day_cases = fetch_latest_day_data("cases")
+        latest_day_vaccines = fetch_latest_day_data("vaccines")
     today = datetime.utcnow() - timedelta(days=1)  # sub 1 for UTC
 
     message = "Could not find current data for the following table(s): "
@@ -59,9 +59,7 @@ def handler(event=None, context=None):
 
 def fetch_latest_day_data(table):
     sql = f"SELECT * FROM {table} ORDER BY reporting_date DESC LIMIT 1;"
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute(sql)
     data = cur.fetchone()
-    conn.close()
     return data  # latest date datetime object
@@ -0,0 +1,153 @@
+"""
+The connection and bulk writes shared by the data functions. A run
+reads and writes everything over one connection, kept open across warm
+invocations, and in one transaction, so a run's rows and its invokes
+row are saved together or not at all
+"""
+import os
+import hashlib
+import logging
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DB_CREDENTIALS = os.getenv("DB_CREDENTIALS")
+if not DB_CREDENTIALS:
+    logger.error({"error": "no DB credentials env var found"})
+
+PAGE_SIZE = 500
+# every API container checks this before serving cached data
+BUMP_DATA_VERSION_SQL = "UPDATE data_version SET version = version + 1, updated_at = now() WHERE id = 1;"
+
+# errors that mean the connection itself is gone rather than the query being bad
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+connection = None  # kept while the container is warm
+
+
+def connect():
+    """
+    The shared connection, opened on first use and again if the last one
+    was closed or the server dropped it while the container was idle
+    """
+    global connection
+    if connection is not None and not connection.closed:
+        try:
+            connection.poll()  # picks up a server side disconnect without a round trip
+            return connection
+        except psycopg2.Error:
+            close_quietly(connection)
+    logger.info("Opening db connection")
+    connection = psycopg2.connect(DB_CREDENTIALS)
+    return connection
+
+
+def cursor():
+    return connect().cursor()
+
+
+@contextmanager
+def session():
+    """
+    Commits everything run over the shared connection inside the block
+    in one go, or rolls it back if the block raises. A connection that
+    broke is closed, so the next run opens a new one
+    """
+    global connection
+    conn = connect()
+    try:
+        yield conn
+        conn.commit()
+    except CONNECTION_ERRORS:
+        close_quietly(conn)
+        connection = None
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def bump_data_version(cur):
+    """
+    Tells the API caches the data changed. Run it in the same transaction
+    as the write, so they never see the new version without the new rows
+    """
+    cur.execute(BUMP_DATA_VERSION_SQL)
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def upsert_rows(cur, table, columns, rows, key="reporting_date", page_size=PAGE_SIZE):
+    """
+    Inserts rows (tuples lined up with columns) into table, or updates the
+    existing row with the same key, sending page_size rows per statement.
+    If a key shows up more than once the last row wins, like it would
+    writing them one at a time. Doesn't commit, so everything the caller
+    writes can go in one transaction. Returns how many rows were inserted
+    and how many updated
+    """
+    key_index = columns.index(key)
+    rows = list({row[key_index]: row for row in rows}.values())
+    if not rows:
+        return {"inserted": 0, "updated": 0}
+
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column != key)
+    sql = f"""
+        INSERT INTO {table} ({", ".join(columns)}) VALUES %s
+        ON CONFLICT ({key}) DO UPDATE SET {updates}, updated_at = now()
+        RETURNING (xmax = 0)
+    """  # xmax is only 0 for rows this statement inserted
+    results = execute_values(cur, sql, rows, page_size=page_size, fetch=True)
+    inserted = sum(1 for (was_inserted,) in results if was_inserted)
+    return {"inserted": inserted, "updated": len(results) - inserted}
+
+
+def fetch_fingerprints(cur, table, columns, key="reporting_date"):
+    """
+    md5 of every row's columns (apart from key) by key, computed in
+    Postgres so only a short hash per day comes back
+    """
+    values = ", ".join(column for column in columns if column != key)
+    cur.execute(f"SELECT {key}::text, md5(ROW({values})::text) FROM {table};")
+    return dict(cur.fetchall())
+
+
+def fingerprint(values):
+    """
+    Same md5 Postgres gives ROW(values)::text, as long as the values are
+    numbers, NULLs or text without commas, quotes, parentheses or spaces.
+    Anything else just never matches, so the row gets written
+    """
+    text = ",".join("" if value is None else str(value) for value in values)
+    return hashlib.md5(f"({text})".encode("utf-8")).hexdigest()
+
+
+def changed_rows(rows, fingerprints, columns, key="reporting_date"):
+    """
+    Rows that are new or differ from their fingerprint, and a count of
+    new, changed and unchanged rows
+    """
+    key_index = columns.index(key)
+    changed = []
+    summary = {"new": 0, "changed": 0, "unchanged": 0}
+    for row in rows:
+        existing = fingerprints.get(str(row[key_index]))
+        values = row[:key_index] + row[key_index + 1 :]
+        if existing is None:
+            summary["new"] += 1
+        elif existing != fingerprint(values):
+            summary["changed"] += 1
+        else:
+            summary["unchanged"] += 1
+            continue
+        changed.append(row)
+    return changed, summary
@@ -0,0 +1,183 @@
+"""
+Fetching the state's ArcGIS data without downloading all of it on every
+poll. Full GeoJSON downloads are conditional (ETag / Last-Modified), so
+a poll of an unchanged dataset is a 304 with no body. When a dataset's
+FeatureServer layer is configured, its query API is used instead to
+check for a date and to pull only the rows and fields that are needed
+
+The vaccine download is big enough that loading it whole sets the
+function's memory size, so it can also be streamed and parsed a feature
+at a time
+"""
+import codecs
+import json
+import logging
+import re
+from datetime import datetime
+
+import requests
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+TIMEOUT = 30  # seconds
+PAGE_SIZE = 2000  # rows per FeatureServer query, the usual server max
+CHUNK_SIZE = 64 * 1024  # bytes read at a time from a streamed download
+FEATURES_START = re.compile(r'"features"\s*:\s*\[')
+FEATURE_SEPARATOR = re.compile(r"[\s,]*")
+DATE_FORMAT = "%m/%d/%Y"  # dates in both datasets' properties
+
+# validators of the last full download per url, kept while the container is warm
+validators = {}
+
+
+def get_geojson(url):
+    """
+    Downloads the GeoJSON at url, or returns None if it hasn't changed
+    since the last download in this container
+    """
+    response = open_geojson(url)
+    if response is None:
+        return None
+    with response:
+        return response.json()
+
+
+def open_geojson(url):
+    """
+    Starts a streamed download of the GeoJSON at url, or returns None if
+    it hasn't changed since the last download in this container. The
+    caller reads the body and closes the response
+    """
+    headers = {}
+    known = validators.get(url, {})
+    if known.get("etag"):
+        headers["If-None-Match"] = known["etag"]
+    if known.get("last_modified"):
+        headers["If-Modified-Since"] = known["last_modified"]
+
+    response = requests.get(url, headers=headers, timeout=TIMEOUT, stream=True)
+    if response.status_code == 304:
+        logger.info(f"{url} not modified")
+        response.close()
+        return None
+    try:
+        response.raise_for_status()
+    except requests.HTTPError:
+        response.close()
+        raise
+    validators[url] = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    return response
+
+
+def iter_features(response, raw_file=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields the features of a streamed GeoJSON response one at a time, so
+    only a chunk and a feature are in memory rather than the whole
+    collection. Every byte of the body is copied to raw_file, if given,
+    as it arrives
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = finished = False
+    for chunk in response.iter_content(chunk_size):
+        if raw_file is not None:
+            raw_file.write(chunk)
+        if finished:
+            continue
+        buffer += text.decode(chunk)
+        if not started:
+            match = FEATURES_START.search(buffer)
+            if not match:
+                continue
+            buffer = buffer[match.end() :]
+            started = True
+
+        position = 0
+        while True:
+            position = FEATURE_SEPARATOR.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if buffer[position] == "]":
+                finished = True
+                break
+            try:
+                feature, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # the rest of this feature is in the next chunk
+            yield feature
+        buffer = "" if finished else buffer[position:]
+
+    if not finished:
+        raise ValueError(f"{response.url} ended before its features did")
+
+
+def forget(url):
+    """
+    Makes the next get_geojson download url in full, e.g. when handling
+    the last download failed and its data needs another go
+    """
+    validators.pop(url, None)
+
+
+def count_features(layer_url, where):
+    response = requests.get(
+        f"{layer_url}/query",
+        params={"where": where, "returnCountOnly": "true", "f": "json"},
+        timeout=TIMEOUT,
+    )
+    response.raise_for_status()
+    return response.json()["count"]
+
+
+def query_features(layer_url, where, out_fields, order_by):
+    """
+    Features matching where with only out_fields, as one GeoJSON feature
+    collection. Pages through results the server caps per request
+    """
+    features = []
+    while True:
+        response = requests.get(
+            f"{layer_url}/query",
+            params={
+                "where": where,
+                "outFields": ",".join(out_fields),
+                "orderByFields": order_by,
+                "returnGeometry": "false",
+                "resultOffset": len(features),
+                "resultRecordCount": PAGE_SIZE,
+                "f": "geojson",
+            },
+            timeout=TIMEOUT,
+        )
+        response.raise_for_status()
+        page = response.json()
+        features += page["features"]
+        exceeded = page.get("exceededTransferLimit") or page.get("properties", {}).get(
+            "exceededTransferLimit"
+        )
+        if not exceeded or not page["features"]:
+            break
+    logger.info(f"Queried {len(features)} features from {layer_url}")
+    return {"type": "FeatureCollection", "features": features}
+
+
+def parse_date(value):
+    """A date from the datasets' MM/DD/YYYY strings, None for anything else"""
+    try:
+        return datetime.strptime(value, DATE_FORMAT).date()
+    except (TypeError, ValueError):
+        return None
+
+
+def dates_from(index, first):
+    """
+    The dates in index, a set of date strings collected while reading
+    features, that are on or after first, oldest first
+    """
+    dates = {parse_date(value) for value in index}
+    return sorted(day for day in dates if day and day >= first)
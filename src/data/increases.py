@@ -0,0 +1,45 @@
+"""
+Daily increases of cumulative counts, worked out a whole column at a
+time over the sorted daily records. Each dataset lists its (cumulative
+column, increase column) pairs, so adding a metric is adding a pair
+"""
+import operator
+
+MISSING = object()  # a column the record doesn't have
+NUMBER_TYPES = (int, float)
+
+
+def add_increases(records, pairs):
+    """
+    Sets each record's increase columns to the change in their cumulative
+    column since the record before. The first record's increases are its
+    cumulative values as they are. A cumulative value that isn't a number
+    makes its increase and the next record's None, apart from a column
+    the record doesn't have, which counts as 0 for the next record
+    """
+    if not records:
+        return records
+    first, rest = records[0], records[1:]
+    for cumulative, increase in pairs:
+        values = [record.get(cumulative, MISSING) for record in records]
+        first[increase] = first.get(cumulative)
+        for record, change in zip(rest, column_increases(values)):
+            record[increase] = change
+    return records
+
+
+def column_increases(values):
+    """
+    Increases from the second value on. A column of only ints, which is
+    nearly every column, is subtracted in one go without any checks
+    """
+    if set(map(type, values)) == {int}:
+        return map(operator.sub, values[1:], values)
+    previous = [0 if value is MISSING else value for value in values]
+    return map(difference, values[1:], previous)
+
+
+def difference(current, previous):
+    if type(current) in NUMBER_TYPES and type(previous) in NUMBER_TYPES:
+        return current - previous
+    return None
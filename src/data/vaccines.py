@@ -1,12 +1,18 @@
 import os
-import io
+import resource
 from datetime import datetime, timedelta
-import json
 import logging
 
 import requests
 import boto3
-import psycopg2
+
+try:
+    from . import archive, db, fetch, increases
+except ImportError:  # Lambda loads src/data/ as top level modules
+    import archive
+    import db
+    import fetch
+    import increases
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -15,18 +21,25 @@ logger.setLevel(logging.INFO)
 BUCKET = os.getenv("S3_BUCKET")
 if not BUCKET:
     logger.error({"error": "no bucket env var found"})
-DB_CREDENTIALS = os.getenv("DB_CREDENTIALS")
-if not DB_CREDENTIALS:
-    logger.error({"error": "no DB credentials env var found"})
 API_URL = (
     "https://opendata.arcgis.com/datasets/fa9730c29ee24c7b8b52361ae3e5ca53_0.geojson"
 )
+# FeatureServer layer behind API_URL. When set, polls only pull the rows and
+# fields cleaning uses
+LAYER_URL = os.getenv("VACCINES_LAYER_URL")
+LAYER_FIELDS = ["publish_date", "date", "category", "section", "metric", "type", "value"]
+# parse the full GeoJSON download as it streams instead of loading it whole
+STREAM_PARSE = os.getenv("VACCINES_STREAM_PARSE", "true").lower() == "true"
+# days before the first new one that are cleaned and saved again, picking up
+# revisions the state makes to recent counts. Anything older is skipped
+REVISION_DAYS = int(os.getenv("REVISION_DAYS", "14"))
 # following two keys aren't required to function, but if not included then the function
-# won't invalidate the cache as soon as new data is available, but it still
-# will every 15 minutes per the normal schedule
+# won't invalidate the cache of the container it reaches right away. API containers
+# still pick up new data through the data_version row bumped on every write
 INVALIDATE_CACHE_KEY = os.getenv("INVALIDATE_CACHE_KEY")
 API_GATEWAY_URL = os.getenv("API_URL")
 EMAIL_TOPIC = os.getenv("EMAIL_TOPIC")
+RAW_PREFIX, CLEAN_PREFIX = archive.PREFIXES["vaccines"]
 
 s3_client = boto3.client("s3")
 sns_client = boto3.client("sns")
@@ -34,36 +47,43 @@ sns_client = boto3.client("sns")
 
 def handler(event=None, context=None):
     try:
-        if already_saved_todays_data():
-            logger.info("Data already grabbed for the day")
-            return "Success"
-
-        logger.info("Requesting raw data")
-        raw_data = get_raw_vaccine_data()
-
-        if new_day_formatted() in str(raw_data):
-            s3_filename = raw_s3_filename()
-            logger.info(f"New data found. Saving to s3://{BUCKET}/{s3_filename}")
-            save_to_s3(raw_data, s3_filename)
+        with db.session():
+            if already_saved_todays_data():
+                logger.info("Data already grabbed for the day")
+                return "Success"
+
+            run = get_run_context()
+            logger.info("Requesting raw data")
+            raw_archive, vaccine_data, new_dates = get_new_vaccine_data(run["new_day"])
+
+            if new_dates:
+                logger.info(
+                    f"New data found for {format_day(new_dates[0])} to "
+                    f"{format_day(new_dates[-1])}. Archiving to s3://{BUCKET}/{RAW_PREFIX}"
+                )
+                archive.save_archive(s3_client, BUCKET, RAW_PREFIX, raw_archive)
 
-            logger.info("Saved to S3. Cleaning data")
-            clean_data = clean_vaccine_data(raw_data)
+                logger.info("Archived. Cleaning data")
+                since = new_dates[0] - timedelta(days=REVISION_DAYS)
+                clean_data = clean_vaccine_data(vaccine_data, run, since=since)
 
-            s3_filename = clean_s3_filename()
-            logger.info(f"Saving cleaned data to s3://{BUCKET}/{s3_filename}")
-            save_to_s3(clean_data, s3_filename)
+                logger.info(f"Archiving cleaned data to s3://{BUCKET}/{CLEAN_PREFIX}")
+                clean_archive = archive.archive_json(clean_data)
+                archive.save_archive(s3_client, BUCKET, CLEAN_PREFIX, clean_archive)
 
-            logger.info("Saving cleaned data to database")
-            save_vaccine_data_to_db(clean_data)
-            log_update_time(new_data=True)
+                logger.info("Saving cleaned data to database")
+                save_vaccine_data_to_db(clean_data)
+            else:
+                logger.info("Data not updated yet")
+            log_update_time(new_data=bool(new_dates))
 
+        if new_dates:
             logger.info("Success")
             invalidate_cache()
-        else:
-            logger.info("Data not updated yet")
-            log_update_time(new_data=False)
+        logger.info(f"Peak memory used: {peak_memory_mb()} MB")
         return "Success"
     except Exception as e:
+        fetch.forget(API_URL)
         message = f"Encountered an error during Vaccine data fetching: {f}"
         topic = "ColoradoCovidData Error - Vaccines"
         sns_client.publish(
@@ -77,15 +97,13 @@ def handler(event=None, context=None):
 
 def already_saved_todays_data():
     """Check if last successful data save was less than 12 hrs ago"""
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
+    cur = db.cursor()
     time_to_check = twelve_hours_ago()
     cur.execute(
         "SELECT * FROM invokes WHERE function_name = %s and invoke_time > %s and new_data = %s",
         ("vaccines", time_to_check, True),
     )
     data = cur.fetchone()
-    conn.close()
     if data:
         return True
     return False
@@ -102,26 +120,44 @@ def invalidate_cache():
 
 
 def log_update_time(new_data=False):
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute(
         "INSERT INTO invokes (function_name, invoke_time, new_data) VALUES (%s, now(), %s)",
         ("vaccines", new_data),
     )
-    conn.commit()
-    conn.close()
+
+
+VACCINES_COLUMNS = [
+    "reporting_date",
+    "daily_qty",
+    "daily_cumulative",
+    "one_dose_increase",
+    "one_dose_total",
+    "fully_immunized_increase",
+    "fully_immunized_total",
+    "daily_pfizer",
+    "daily_moderna",
+    "pfizer_total",
+    "moderna_total",
+    "distributed_increase",
+    "distrubuted_total",
+    "total_vaccine_providers",
+    "daily_jandj",
+    "jandj_total",
+]
 
 
 def save_vaccine_data_to_db(clean_data):
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
-    i = 0
-    for day in clean_data:
-        i += 1
-
-        sql_date = reporting_date_to_formatted(day.get("date"))
-        sql_data = (
-            sql_date,
+    """
+    Upserts the days that are new or changed since they were last saved,
+    along with the data version bump. The handler's session commits them
+    with the run's invokes row, so the API never sees half of a day's
+    update. Unchanged days aren't touched, keeping their updated_at and
+    leaving no dead tuples behind
+    """
+    rows = [
+        (
+            reporting_date_to_formatted(day.get("date")),
             day.get("daily_increase"),
             day.get("daily_cumulative"),
             day.get("one_dose_increase"),
@@ -138,37 +174,27 @@ def save_vaccine_data_to_db(clean_data):
             day.get("jandj_daily"),
             day.get("jandj_cumulative"),
         )
+        for day in clean_data
+    ]
 
-        sql_vars = sql_data + sql_data + (sql_date,)
-
-        sql = """
-            INSERT INTO vaccines (reporting_date, daily_qty, daily_cumulative, one_dose_increase, 
-            one_dose_total, fully_immunized_increase, fully_immunized_total, daily_pfizer, daily_moderna,
-            pfizer_total, moderna_total, distributed_increase, distrubuted_total, total_vaccine_providers,
-            daily_jandj, jandj_total)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (reporting_date) DO UPDATE SET
-            reporting_date = %s, daily_qty = %s, daily_cumulative = %s, one_dose_increase = %s,
-            one_dose_total = %s, fully_immunized_increase = %s, fully_immunized_total = %s, daily_pfizer = %s, daily_moderna = %s,
-            pfizer_total = %s, moderna_total = %s, distributed_increase = %s, distrubuted_total = %s, total_vaccine_providers = %s,
-            daily_jandj = %s, jandj_total = %s
-            WHERE vaccines.reporting_date = %s;
-        """
-
-        cur.execute(sql, sql_vars)
-        if i % 25 == 0:
-            conn.commit()
-
-    conn.commit()
-    conn.close()
+    cur = db.cursor()
+    fingerprints = db.fetch_fingerprints(cur, "vaccines", VACCINES_COLUMNS)
+    rows, summary = db.changed_rows(rows, fingerprints, VACCINES_COLUMNS)
+    if not rows:
+        logger.info(f"No vaccine data changes: {summary}")
+        return {"inserted": 0, "updated": 0}
+    logger.info(f"Vaccine data changes from {rows[0][0]} to {rows[-1][0]}: {summary}")
+    counts = db.upsert_rows(cur, "vaccines", VACCINES_COLUMNS, rows)
+    db.bump_data_version(cur)
+    logger.info(f"Saved vaccine data: {counts['inserted']} inserted, {counts['updated']} updated")
+    return counts
 
 
 def fetch_latest_day_data():
     sql = "SELECT * FROM vaccines ORDER BY reporting_date DESC LIMIT 1;"
-    conn = psycopg2.connect(DB_CREDENTIALS)
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute(sql)
     response = cur.fetchone()
-    conn.close()
     if response:
         return {
             "reporting_date": response[0],
@@ -186,9 +212,17 @@ def format_day(date):
     return date.strftime("%m/%d/%Y")
 
 
-def new_day_formatted():
-    new_day = fetch_latest_day_data()["reporting_date"]  # + timedelta(days=1)
-    return format_day(new_day)
+def get_run_context():
+    """
+    What a run needs to know about the saved data, looked up once as it
+    starts and passed to the stages after it, so cleaning never queries
+    the database. new_day is the last day saved, which is due again
+    """
+    latest_day = fetch_latest_day_data()
+    return {
+        "latest_day": latest_day,
+        "new_day": format_day(latest_day["reporting_date"]),
+    }
 
 
 def yesterday():
@@ -202,173 +236,121 @@ def update_day(days, reporting_date, key, value):
         days[reporting_date] = {key: value}
 
 
-def clean_vaccine_data(raw_data):
-    daily_data = extract_vaccine_data(raw_data)
-    administration_counts, state_counts = filter_latest_vaccine_data(daily_data)
-    flattened_data = flatten_data(administration_counts)
-    combined_data = combine_counts(flattened_data, state_counts)
-    sorted_data = sort_data(combined_data)
-    standardized_data = standardize_metric_names(sorted_data)
-    cleaned_data = add_metric_increases(standardized_data)
-
-    return cleaned_data
-
-
-def extract_vaccine_data(raw_data):
-    daily_data = raw_data["features"]
-    return [day["properties"] for day in daily_data]
-
-
-def filter_latest_vaccine_data(daily_data):
-    administration_counts = []
-    state_counts = []
-    new_day = new_day_formatted()
-    for cat in daily_data:
-        if (
-            cat["publish_date"] == new_day
-            and cat["category"] == "Administration"
-            and cat["metric"] != "Weekly"
-            and cat["type"] != "Unspecified COVID Vaccine"
-        ):
-            administration_counts.append(cat)
-        if (
-            cat["category"] == "Cumulative counts to date"
-            and cat["section"] == "State Data"
-        ):
-            state_counts.append(cat)
-            state_counts[-1]["date"] = state_counts[-1]["publish_date"]
-    return administration_counts, state_counts
-
-
-def flatten_data(days):
-    new_day = new_day_formatted()
-    return [
-        {
-            "metric": day["metric"],
-            "type": day["type"],
-            "date": day["date"],
-            "value": day["value"],
-            "publish_date": day["publish_date"],
-        }
-        for day in days
-        if day["publish_date"] == new_day
-    ]
-
-
-def combine_counts(flattened_data, state_counts):
-    combined_daily = {}
-    for day in flattened_data:
-        if not combined_daily.get(day["date"]):
-            combined_daily[day["date"]] = {}
-        try:
-            combined_daily[day["date"]][day["type"] + " " + day["metric"]] = day[
-                "value"
-            ]
-        except:
-            combined_daily[day["date"]][day["metric"]] = day["value"]
-
-    for day in state_counts:
-        if not combined_daily.get(day["date"]):
-            combined_daily[day["date"]] = {}
-        combined_daily[day["date"]][day["metric"]] = day["value"]
-
-    return [{"date": day[0], **day[1]} for day in combined_daily.items()]
-
-
-def standardize_metric_names(sorted_data):
-    replacements = {
-        "All COVID Vaccines Cumulative Daily": "daily_cumulative",
-        "Moderna Cumulative Daily": "moderna_cumulative",
-        "Pfizer Cumulative Daily": "pfizer_cumulative",
-        "Janssen Cumulative Daily": "jandj_cumulative",
-        "All COVID Vaccines Daily": "daily",
-        "Moderna Daily": "moderna_daily",
-        "Pfizer Daily": "pfizer_daily",
-        "Janssen Daily": "jandj_daily",
-        "People Immunized with One Dose": "one_dose_cumulative",
-        "People Fully Immunized": "fully_immunized_cumulative",
-        "date": "date",
-        "Cumulative Doses Administered": "daily_cumulative_2",
-        "Cumulative Doses Distributed": "distributed_cumulative",
-        "Total Vaccine Providers": "total_vaccine_providers",
-    }
-    updated_data = []
-    for day in sorted_data:
-        temp_day = {}
-        for key, val in day.items():
-            if "Weekly" in key:
-                continue
-            try:
-                temp_day[replacements[key]] = int(val)
-            except KeyError:
-                logger.error(f"Found unknown key: {key}")
-            except TypeError as e:
-                logger.error(f"Found unknown type: {e} for key {key}")
-            except ValueError:
-                temp_day[replacements[key]] = val
-        updated_data.append(temp_day)
-
-    for day in updated_data:
-        if day.get("daily_cumulative_2"):
-            day["daily_cumulative"] = int(day.get("daily_cumulative_2"))
-            del day["daily_cumulative_2"]
-        if day.get("daily"):  # confusing metric that isn't what it says
-            del day["daily"]
-    return updated_data
-
-
-def add_metric_increases(standardized_data):
-    total_days = len(standardized_data)
-    for i in range(total_days):
-        if i == 0:
-            standardized_data[i]["daily_increase"] = standardized_data[i].get(
-                "daily_cumulative"
-            )
-            standardized_data[i]["distributed_increase"] = standardized_data[i].get(
-                "distributed_cumulative"
-            )
-            standardized_data[i]["one_dose_increase"] = standardized_data[i].get(
-                "one_dose_cumulative"
-            )
-            standardized_data[i]["fully_immunized_increase"] = standardized_data[i].get(
-                "fully_immunized_cumulative"
-            )
+# names vaccine metrics are saved by, from the "type metric" of administration
+# counts or the metric of state counts
+METRIC_NAMES = {
+    "All COVID Vaccines Cumulative Daily": "daily_cumulative",
+    "Moderna Cumulative Daily": "moderna_cumulative",
+    "Pfizer Cumulative Daily": "pfizer_cumulative",
+    "Janssen Cumulative Daily": "jandj_cumulative",
+    "All COVID Vaccines Daily": "daily",
+    "Moderna Daily": "moderna_daily",
+    "Pfizer Daily": "pfizer_daily",
+    "Janssen Daily": "jandj_daily",
+    "People Immunized with One Dose": "one_dose_cumulative",
+    "People Fully Immunized": "fully_immunized_cumulative",
+    "date": "date",
+    "Cumulative Doses Administered": "daily_cumulative_2",
+    "Cumulative Doses Distributed": "distributed_cumulative",
+    "Total Vaccine Providers": "total_vaccine_providers",
+}
+# (cumulative column, increase column) for each count cleaning works out
+VACCINES_INCREASES = [
+    ("daily_cumulative", "daily_increase"),
+    ("distributed_cumulative", "distributed_increase"),
+    ("one_dose_cumulative", "one_dose_increase"),
+    ("fully_immunized_cumulative", "fully_immunized_increase"),
+]
+UNSAVED = object()  # the latest value of a metric was empty, so the day goes without it
+
+
+def clean_vaccine_data(raw_data, run, since=None):
+    """
+    One record per date, keyed by the metric names that are saved, from
+    since on or for every date if it's None. The day before since is
+    only used for the first day's increases. Features are bucketed by
+    date in a single pass that parses each date once. Only uses raw_data
+    and the run context, so it can be run on its own
+    """
+    days = {}  # date: (parsed date, administration counts, state counts)
+    for feature in raw_data["features"]:
+        cat = feature["properties"]
+        if is_administration_count(cat, run["new_day"]):
+            date, key, from_state = cat["date"], administration_key(cat), False
+        elif is_state_count(cat):
+            date, key, from_state = cat["publish_date"], cat["metric"], True
         else:
-            try:
-                standardized_data[i]["daily_increase"] = standardized_data[i].get(
-                    "daily_cumulative"
-                ) - standardized_data[i - 1].get("daily_cumulative", 0)
-            except TypeError:
-                standardized_data[i]["daily_increase"] = None
-
-            try:
-                standardized_data[i]["distributed_increase"] = standardized_data[i].get(
-                    "distributed_cumulative"
-                ) - standardized_data[i - 1].get("distributed_cumulative", 0)
-            except TypeError:
-                standardized_data[i]["distributed_increase"] = None
-
-            try:
-                standardized_data[i]["one_dose_increase"] = standardized_data[i].get(
-                    "one_dose_cumulative"
-                ) - standardized_data[i - 1].get("one_dose_cumulative", 0)
-            except TypeError:
-                standardized_data[i]["one_dose_increase"] = None
-            try:
-                standardized_data[i]["fully_immunized_increase"] = standardized_data[
-                    i
-                ].get("fully_immunized_cumulative") - standardized_data[i - 1].get(
-                    "fully_immunized_cumulative", 0
-                )
-            except TypeError:
-                standardized_data[i]["fully_immunized_increase"] = None
-    return standardized_data
+            continue
+
+        day = days.get(date)
+        if day is None:
+            day = days[date] = (datetime.strptime(date, "%m/%d/%Y"), {}, {})
+        if key is None or "Weekly" in key:
+            continue
+        name = METRIC_NAMES.get(key)
+        if name is None:
+            logger.error(f"Found unknown key: {key}")
+            continue
+        counts = day[2] if from_state else day[1]
+        counts[name] = metric_value(key, cat["value"])
+
+    ordered = sorted(days.items(), key=lambda item: item[1][0])
+    if since is not None:
+        first = next(
+            (i for i, (_, day) in enumerate(ordered) if day[0].date() >= since), len(ordered)
+        )
+        ordered = ordered[max(first - 1, 0) :]
+
+    records = []
+    for date, (_, administration_counts, state_counts) in ordered:
+        # state counts win over administration counts of the same metric
+        values = {"date": date, **administration_counts, **state_counts}
+        record = {name: value for name, value in values.items() if value is not UNSAVED}
+        if record.get("daily_cumulative_2"):
+            record["daily_cumulative"] = int(record.pop("daily_cumulative_2"))
+        if record.get("daily"):  # confusing metric that isn't what it says
+            del record["daily"]
+        records.append(record)
+    increases.add_increases(records, VACCINES_INCREASES)
+
+    if since is None:
+        return records
+    return [record for record, (_, day) in zip(records, ordered) if day[0].date() >= since]
+
+
+def administration_key(cat):
+    if isinstance(cat["type"], str) and isinstance(cat["metric"], str):
+        return cat["type"] + " " + cat["metric"]
+    return cat["metric"]
+
+
+def metric_value(key, value):
+    """
+    Counts as ints. Text that isn't a number is kept as it is, and an
+    empty value is UNSAVED
+    """
+    if type(value) is int:
+        return value
+    try:
+        return int(value)
+    except TypeError as e:
+        logger.error(f"Found unknown type: {e} for key {key}")
+        return UNSAVED
+    except ValueError:
+        return value
+
+
+def is_administration_count(cat, new_day):
+    return (
+        cat["publish_date"] == new_day
+        and cat["category"] == "Administration"
+        and cat["metric"] != "Weekly"
+        and cat["type"] != "Unspecified COVID Vaccine"
+    )
 
 
-def sort_data(combined_data):
-    return sorted(
-        combined_data, key=lambda day: datetime.strptime(day["date"], "%m/%d/%Y")
-    )
+def is_state_count(cat):
+    return cat["category"] == "Cumulative counts to date" and cat["section"] == "State Data"
 
 
 def reporting_date_to_formatted(date):
@@ -376,9 +358,75 @@ def reporting_date_to_formatted(date):
     return date_time.strftime("%Y-%m-%d")
 
 
-def get_raw_vaccine_data():
-    res = requests.get(API_URL)
-    return res.json()
+def get_new_vaccine_data(new_day):
+    """
+    An archive of the raw download, the feature collection to clean and
+    the dates in it from new_day on, oldest first. Nones and no dates if
+    the source has nothing from new_day on yet
+    """
+    if STREAM_PARSE and not LAYER_URL:
+        return stream_raw_vaccine_data(new_day)
+    raw_data = get_raw_vaccine_data(new_day)
+    if not raw_data:
+        return None, None, []
+    index = set()
+    for feature in raw_data["features"]:
+        index_dates(index, feature["properties"])
+    new_dates = fetch.dates_from(index, fetch.parse_date(new_day))
+    if not new_dates:
+        return None, None, []
+    return archive.archive_json(raw_data), raw_data, new_dates
+
+
+def index_dates(index, cat):
+    """
+    Adds the dates a feature is for to index. The run's new_day is the
+    last day saved, which is due again, so dates from it on are new
+    """
+    index.add(cat.get("publish_date"))
+    index.add(cat.get("date"))
+
+
+def stream_raw_vaccine_data(new_day):
+    """
+    Reads the GeoJSON download a chunk at a time rather than holding it
+    in memory. The raw bytes are compressed into an archive file as they
+    arrive, and only the features cleaning uses are kept
+    """
+    response = fetch.open_geojson(API_URL)
+    if response is None:
+        return None, None, []
+    raw_archive = archive.ArchiveFile()
+    features = []
+    index = set()
+    try:
+        with response:
+            for feature in fetch.iter_features(response, raw_archive):
+                cat = feature["properties"]
+                index_dates(index, cat)
+                if is_administration_count(cat, new_day) or is_state_count(cat):
+                    features.append(feature)
+    except Exception:
+        raw_archive.close()
+        raise
+    logger.info(f"Kept {len(features)} features from {raw_archive.size} bytes")
+    new_dates = fetch.dates_from(index, fetch.parse_date(new_day))
+    if not new_dates:
+        raw_archive.close()
+        return None, None, []
+    return raw_archive, {"features": features}, new_dates
+
+
+def get_raw_vaccine_data(new_day):
+    """None if the source is unchanged since the last poll"""
+    if not LAYER_URL:
+        return fetch.get_geojson(API_URL)
+    # the rows filter_latest_vaccine_data keeps
+    where = (
+        f"publish_date = '{new_day}' OR "
+        "(category = 'Cumulative counts to date' AND section = 'State Data')"
+    )
+    return fetch.query_features(LAYER_URL, where, LAYER_FIELDS, order_by="date")
 
 
 def twelve_hours_ago():
@@ -386,10 +434,12 @@ def twelve_hours_ago():
     return time.strftime("%Y-%m-%d %H:%M:%S")
 
 
-def save_to_s3(json_data, s3_filename):
-    data = json.dumps(json_data).encode("utf-8")
-    raw_data = io.BytesIO(data)
-    s3_client.upload_fileobj(raw_data, BUCKET, s3_filename)
+def peak_memory_mb():
+    """
+    Most memory this container has used so far, in MB, to size the
+    function's MemorySize by. Linux reports ru_maxrss in KB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
 
 
 def today_formatted():
@@ -401,12 +451,3 @@ def yesterday_formatted():
     today = datetime.today() - timedelta(days=1, hours=7)
     return today.strftime("%m/%d/%Y")
 
-
-def raw_s3_filename():
-    today = datetime.today() - timedelta(hours=7)
-    return f"data/raw_vaccine_data/{today.strftime('%Y%m%d')}.json"
-
-
-def clean_s3_filename():
-    today = datetime.today() - timedelta(hours=7)
-    return f"data/clean_vaccine_data/{today.strftime('%Y%m%d')}.json"
@@ -18,8 +18,15 @@ def mock_return(*args, **kwargs):
 def local_api(monkeypatch, mock_return):
     monkeypatch.setattr(boto3, "client", mock_return)
     monkeypatch.setattr(psycopg2, "connect", mock_return)
+    mock_return.return_value.cursor.return_value.fetchall.return_value = []
     from src.api import app
 
+    app.core.todays_data = {}
+    app.core.data_version_checked = None
+    # refreshes run inline unless a test turns stale-while-revalidate back on
+    monkeypatch.setattr(app.core, "STALE_WHILE_REVALIDATE", False)
+    app.core.db.clear_pool()
+    app.metrics.reset()
     return app
 
 
@@ -34,7 +41,7 @@ def freeze_datetime(monkeypatch):
         def strptime(cls, date, formatting):
             return datetime.strptime(date, '%Y-%m-%d %H:%M:%S.%f')
 
-    monkeypatch.setattr("src.api.app.datetime", ftdatetime)
+    monkeypatch.setattr("src.api.core.datetime", ftdatetime)
 
 
 @pytest.fixture()
@@ -1,66 +1,793 @@
+import base64
+import gzip
 import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 from unittest.mock import MagicMock
 
+import numpy as np
 import pytest
 import boto3
 import psycopg2
 
 
-def test_data_endpoint(monkeypatch, apigw_event, mocker, local_api, freeze_datetime):
-    def daily_cases():
-        return {"mock": "daily_cases"}
+def decode_body(ret):
+    body = ret["body"]
+    if ret.get("isBase64Encoded"):
+        body = base64.b64decode(body)
+    if ret["headers"].get("Content-Encoding") == "gzip":
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+
+def cache_payload(local_api, data, last_updated):
+    local_api.core.todays_data = {
+        "datasets": {},
+        "last_updated": last_updated,
+        "payloads": {"rows": local_api.core.build_payload(data, last_updated)},
+        "slices": OrderedDict(),
+    }
+    return local_api.core.todays_data["payloads"]["rows"]
 
-    def daily_vaccines():
-        return {"mock": "daily_vaccines"}
 
-    def ave_cases():
-        return {"mock": "ave_cases"}
+def mock_datasets():
+    return {
+        "daily_cases": [(date(2021, 3, 1),) + (1,) * 9 + (datetime(2021, 3, 1, 12),) * 2],
+        "daily_vaccines": [(date(2021, 3, 1),) + (3,) * 15 + (datetime(2021, 3, 1, 12),) * 2],
+        "ave_cases": [(date(2021, 3, 1),) + (Decimal("2"),) * 5],
+        "ave_vaccines": [(date(2021, 3, 1),) + (Decimal("4"),) * 7],
+    }
 
-    def ave_vaccines():
-        return {"mock": "ave_vaccines"}
 
-    monkeypatch.setattr(local_api, "get_daily_cases", daily_cases)
-    monkeypatch.setattr(local_api, "get_daily_vaccines", daily_vaccines)
-    monkeypatch.setattr(local_api, "get_ave_cases", ave_cases)
-    monkeypatch.setattr(local_api, "get_ave_vaccines", ave_vaccines)
+def test_data_endpoint(monkeypatch, apigw_event, mocker, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "get_combined_rows", mock_datasets)
 
     ret = local_api.app(apigw_event, "")
-    data = json.loads(ret["body"])
+    data = decode_body(ret)
 
     assert ret["statusCode"] == 200
-    assert data['data']['daily_cases'] == daily_cases()
-    assert data['data']['daily_vaccines'] == daily_vaccines()
-    assert data['data']['ave_cases'] == ave_cases()
-    assert data['data']['ave_vaccines'] == ave_vaccines()
+    assert data['data'] == local_api.core.format_datasets(mock_datasets(), "rows")
+    assert data['data']['ave_cases'][0]['tested_increase'] == 2.0
     assert data['last_updated'] == '2021-10-05 03:02:01.142314'
 
 
+def test_columnar_data_endpoint(monkeypatch, apigw_event, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "get_combined_rows", mock_datasets)
+    apigw_event["queryStringParameters"] = {"format": "columnar"}
+
+    ret = local_api.app(apigw_event, "")
+    data = decode_body(ret)["data"]
+
+    assert ret["statusCode"] == 200
+    assert data["daily_cases"]["reporting_date"] == ["2021-03-01"]
+    assert data["daily_cases"]["created_at"] == ["2021-03-01 05:00:00"]
+    assert data["ave_vaccines"]["daily_jandj"] == [4.0]
+    for name, rows in local_api.core.format_datasets(mock_datasets(), "rows").items():
+        assert [dict(zip(data[name], values)) for values in zip(*data[name].values())] == rows
+
+
+def test_unknown_data_format(apigw_event, local_api):
+    apigw_event["queryStringParameters"] = {"format": "xml"}
+
+    ret = local_api.app(apigw_event, "")
+
+    assert ret["statusCode"] == 400
+
+
+def test_combined_data_single_query(local_api):
+    cases_row = (date(2021, 3, 2),) + (1,) * 9 + (datetime(2021, 3, 2, 12),) * 2
+    vaccines_row = (date(2021, 3, 2),) + (3,) * 15 + (datetime(2021, 3, 2, 12),) * 2
+    later_cases_row = (date(2021, 3, 3),) + (2,) * 9 + (datetime(2021, 3, 3, 12),) * 2
+    rows = [
+        cases_row + (None,) * len(vaccines_row),
+        later_cases_row + vaccines_row,
+        (None,) * len(cases_row) + vaccines_row,
+    ]
+    connect = psycopg2.connect
+    connect.reset_mock()
+    connect.return_value.cursor.return_value.fetchall.return_value = rows
+
+    data = local_api.core.format_datasets(local_api.core.get_combined_rows(), "rows")
+
+    assert connect.call_count == 1
+    assert connect.return_value.cursor.return_value.execute.call_count == 1
+    assert len(data["daily_cases"]) == 2
+    assert len(data["daily_vaccines"]) == 2
+    assert data["daily_cases"][1]["tested"] == 2
+    assert data["daily_cases"][1]["updated_at"] == "2021-03-03 05:00:00"
+    assert data["ave_cases"][1] == {
+        "reporting_date": "2021-03-03",
+        "hospitalized_currently": 2.0,
+        "positive_increase": 2.0,
+        "death_increase": 2.0,
+        "hospitalized_increase": 2.0,
+        "tested_increase": 2.0,
+    }
+    assert data["ave_vaccines"][0]["daily_jandj"] == 3.0
+    assert data["daily_vaccines"][0]["total_vaccine_providers"] == 3
+
+
+def sql_weekly_average(values, i):
+    window = [value for value in values[max(0, i - 6) : i + 1] if value is not None]
+    if not window:
+        return None
+    average = Decimal(sum(window)) / Decimal(len(window))
+    return average.quantize(Decimal(1), rounding=ROUND_HALF_UP)
+
+
+def test_weekly_averages_match_postgres(local_api):
+    values = [1, 2, None, -3, -4, 5, 6, 10, None, None, None, None, None, None, None, 7, 0, -1, -2, 100]
+    rows = [(i, value, 2 * i) for i, value in enumerate(values)]
+
+    averages = local_api.core.weekly_averages(rows, ["reporting_date", "a", "b"], ["reporting_date", "a", "b"])
+
+    assert [row[1] for row in averages] == [sql_weekly_average(values, i) for i in range(len(values))]
+    assert averages[1][1] == 2  # 1.5 rounds up
+    assert averages[14][1] is None
+    assert averages[3][2] == 3
+    assert local_api.core.weekly_averages(rows, ["reporting_date", "a", "b"], ["reporting_date", "a"], start=12) == [
+        (i, sql_weekly_average(values, i)) for i in range(12, len(values))
+    ]
+    assert local_api.core.round_average(-3, 2) == -2  # -1.5 rounds away from zero
+
+
 def test_valid_cached_response(monkeypatch, apigw_event, mocker, local_api, freeze_datetime):
     mock_passing_date = {"data": "mock", "last_updated": '2021-10-05 03:12:01.142314'}
-    local_api.todays_data = mock_passing_date
+    cache_payload(local_api, "mock", '2021-10-05 03:12:01.142314')
 
     ret = local_api.app(apigw_event, "")
-    data = json.loads(ret["body"])
+    data = decode_body(ret)
 
     assert data == mock_passing_date
 
 
+def test_cached_response_encodings(apigw_event, local_api, freeze_datetime):
+    payload = cache_payload(local_api, "mock", '2021-10-05 03:12:01.142314')
+
+    apigw_event["headers"]["Accept-Encoding"] = "gzip;q=0, identity"
+    ret = local_api.app(apigw_event, "")
+    assert "Content-Encoding" not in ret["headers"]
+    assert json.loads(ret["body"])["data"] == "mock"
+
+    apigw_event["headers"]["Accept-Encoding"] = "gzip, br"
+    ret = local_api.app(apigw_event, "")
+    assert ret["headers"]["Content-Encoding"] == "br"
+    assert ret["isBase64Encoded"]
+    assert ret["headers"]["ETag"] == f'W/"{payload["etag"]}-br"'
+
+
+def test_not_modified_response(apigw_event, local_api, freeze_datetime):
+    cache_payload(local_api, "mock", '2021-10-05 03:12:01.142314')
+    ret = local_api.app(apigw_event, "")
+
+    apigw_event["headers"]["If-None-Match"] = ret["headers"]["ETag"]
+    ret = local_api.app(apigw_event, "")
+
+    assert ret["statusCode"] == 304
+    assert ret["body"] == ""
+
+    apigw_event["headers"]["If-None-Match"] = '"somethingelse"'
+    ret = local_api.app(apigw_event, "")
+
+    assert ret["statusCode"] == 200
+
+
+def test_etag_ignores_load_time(apigw_event, local_api, freeze_datetime):
+    """Another container, or this one after a reload, has the same data with a later last_updated"""
+    payload = local_api.core.build_payload({"a": [1]}, "2021-10-05 03:00:00.000000")
+    assert json.loads(payload["identity"]) == {
+        "data": {"a": [1]}, "last_updated": "2021-10-05 03:00:00.000000"
+    }
+    apigw_event["headers"]["If-None-Match"] = f'W/"{payload["etag"]}"'
+
+    cache_payload(local_api, {"a": [1]}, "2021-10-05 03:12:01.142314")
+    assert local_api.app(apigw_event, "")["statusCode"] == 304
+
+    cache_payload(local_api, {"a": [2]}, "2021-10-05 03:12:01.142314")
+    assert local_api.app(apigw_event, "")["statusCode"] == 200
+
+
 def test_expired_data(monkeypatch, apigw_event, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "CACHE_TTL", timedelta(minutes=15))
     invalid_datetime = '2021-10-05 02:45:01.142314'
-    still_valid = local_api.data_still_valid(invalid_datetime)
+    still_valid = local_api.core.data_still_valid(invalid_datetime)
 
     assert still_valid == False
 
 
 def test_valid_data(monkeypatch, apigw_event, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "CACHE_TTL", timedelta(minutes=15))
     invalid_datetime = '2021-10-05 02:50:01.142314'
-    still_valid = local_api.data_still_valid(invalid_datetime)
+    still_valid = local_api.core.data_still_valid(invalid_datetime)
 
     assert still_valid == True
 
 
 def test_get_formatted_daily_data(monkeypatch, local_api):
-    actual = local_api.format_data([['11', '12'], ['21', '22'], ['31', '32']], ['first', 'second'])
+    actual = local_api.core.format_data([['11', '12'], ['21', '22'], ['31', '32']], ['first', 'second'])
     expected = [{'first': '11', 'second': '12'}, {'first': '21', 'second': '22'}, {'first': '31', 'second': '32'}]
 
     assert actual == expected
+
+
+def pooled_connection(rows=None):
+    conn = MagicMock(closed=0)
+    conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    conn.cursor.return_value.fetchall.return_value = rows
+    return conn
+
+
+def test_pool_reuses_warm_connection(monkeypatch, local_api):
+    db = local_api.core.db
+    monkeypatch.setattr(db, "pool_stats", {"hits": 0, "misses": 0, "stale": 0, "reconnects": 0})
+    connect = MagicMock(return_value=pooled_connection([(1,)]))
+    monkeypatch.setattr(psycopg2, "connect", connect)
+
+    assert db.fetch_data("SELECT 1;") == [(1,)]
+    assert db.fetch_data("SELECT 1;") == [(1,)]
+
+    assert connect.call_count == 1
+    assert db.pool_stats["hits"] == 1
+    assert db.pool_stats["misses"] == 1
+
+
+def test_pool_drops_connections_past_max_idle(monkeypatch, local_api):
+    db = local_api.core.db
+    monkeypatch.setattr(db, "pool_stats", {"hits": 0, "misses": 0, "stale": 0, "reconnects": 0})
+    monkeypatch.setattr(db, "MAX_IDLE_SECONDS", -1)
+    first, second = pooled_connection([(1,)]), pooled_connection([(2,)])
+    monkeypatch.setattr(psycopg2, "connect", MagicMock(side_effect=[first, second]))
+
+    db.fetch_data("SELECT 1;")
+    assert db.fetch_data("SELECT 1;") == [(2,)]
+
+    assert first.close.called
+    assert db.pool_stats["stale"] == 1
+
+
+def test_pool_reconnects_when_connection_went_stale(monkeypatch, local_api):
+    db = local_api.core.db
+    monkeypatch.setattr(db, "pool_stats", {"hits": 0, "misses": 0, "stale": 0, "reconnects": 0})
+    first, second = pooled_connection([(1,)]), pooled_connection([(2,)])
+    monkeypatch.setattr(psycopg2, "connect", MagicMock(side_effect=[first, second]))
+
+    db.fetch_data("SELECT 1;")
+    first.cursor.return_value.execute.side_effect = psycopg2.OperationalError("server closed the connection")
+
+    assert db.fetch_data("SELECT 1;") == [(2,)]
+    assert db.pool_stats["reconnects"] == 1
+    assert first.close.called
+
+
+def test_sliced_data_endpoint(monkeypatch, apigw_event, local_api, freeze_datetime):
+    def datasets():
+        data = mock_datasets()
+        for name, rows in data.items():
+            data[name] = [(date(2021, 2, 28),) + rows[0][1:]] + rows
+        return data
+
+    get_combined_rows = MagicMock(side_effect=datasets)
+    monkeypatch.setattr(local_api.core, "get_combined_rows", get_combined_rows)
+    apigw_event["queryStringParameters"] = {
+        "since": "2021-03-01",
+        "until": "2021-05-31",
+        "fields": "positive_increase",
+    }
+
+    ret = local_api.app(apigw_event, "")
+    data = decode_body(ret)["data"]
+
+    assert ret["statusCode"] == 200
+    assert data == {
+        "daily_cases": [{"reporting_date": "2021-03-01", "positive_increase": 1}],
+        "ave_cases": [{"reporting_date": "2021-03-01", "positive_increase": 2.0}],
+    }
+
+    local_api.app(apigw_event, "")
+    assert get_combined_rows.call_count == 1
+    assert len(local_api.core.todays_data["slices"]) == 1
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"since": "03/01/2021"},
+        {"since": "2021-03-02", "until": "2021-03-01"},
+        {"fields": "positive_increase,password"},
+        {"fields": "reporting_date"},
+    ],
+)
+def test_invalid_slice_params(apigw_event, local_api, params):
+    apigw_event["queryStringParameters"] = params
+
+    ret = local_api.app(apigw_event, "")
+
+    assert ret["statusCode"] == 400
+
+
+def test_sliced_data_cache_evicts_least_recently_used(monkeypatch, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "SLICE_CACHE_SIZE", 2)
+    cached = {
+        "datasets": mock_datasets(),
+        "last_updated": "2021-10-05 03:00:00.000000",
+        "slices": OrderedDict(),
+    }
+    columns = local_api.core.DATASET_COLUMNS
+
+    for since in [date(2021, 1, 1), date(2021, 2, 1), date(2021, 1, 1), date(2021, 3, 1)]:
+        local_api.core.get_sliced_payload(cached, "rows", since, None, None, columns)
+
+    assert list(cached["slices"]) == [
+        ("rows", date(2021, 1, 1), None, None),
+        ("rows", date(2021, 3, 1), None, None),
+    ]
+
+
+def expired_cache(local_api, datasets, last_updated="2021-10-05 02:00:00.000000"):
+    local_api.core.todays_data = {
+        "datasets": datasets,
+        "data_version": 4,
+        "max_updated_at": local_api.core.get_max_updated_at(datasets),
+        "last_updated": last_updated,
+        "payloads": {"rows": "stale payload"},
+        "slices": OrderedDict(),
+    }
+
+
+def test_refresh_without_updated_rows_keeps_payloads(monkeypatch, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "get_published", dict)
+    monkeypatch.setattr(local_api.core, "CACHE_TTL", timedelta(minutes=15))
+    monkeypatch.setattr(local_api.core, "get_data_version", lambda: None)
+    expired_cache(local_api, mock_datasets())
+    fetch_data = MagicMock(return_value=[("cases", None, 1), ("vaccines", None, 1)])
+    monkeypatch.setattr(local_api.core.db, "fetch_data", fetch_data)
+
+    local_api.core.refresh_data()
+
+    assert fetch_data.call_count == 1
+    assert fetch_data.call_args[0][1] == [datetime(2021, 3, 1, 12), datetime(2021, 3, 1, 12)]
+    assert local_api.core.todays_data["payloads"] == {"rows": "stale payload"}
+    assert local_api.core.todays_data["last_updated"] == "2021-10-05 03:02:01.142314"
+
+
+def test_refresh_merges_updated_rows(monkeypatch, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "get_published", dict)
+    monkeypatch.setattr(local_api.core, "get_data_version", lambda: 5)
+    datasets = mock_datasets()
+    datasets["daily_cases"].append((date(2021, 3, 2),) + (1,) * 9 + (datetime(2021, 3, 1, 12),) * 2)
+    datasets["ave_cases"].append((date(2021, 3, 2),) + (Decimal("2"),) * 5)
+    expired_cache(local_api, datasets)
+
+    updated = (date(2021, 3, 2),) + (7,) * 9 + (datetime(2021, 3, 1, 12), datetime(2021, 3, 2, 12))
+    added = (date(2021, 3, 3),) + (8,) * 9 + (datetime(2021, 3, 3, 12),) * 2
+    fetch_data = MagicMock(
+        side_effect=[
+            [("cases", date(2021, 3, 2), 3), ("vaccines", None, 1)],
+            [updated, added],
+        ]
+    )
+    monkeypatch.setattr(local_api.core.db, "fetch_data", fetch_data)
+
+    local_api.core.refresh_data()
+
+    sql, params = fetch_data.call_args[0]
+    assert "FROM vaccines" not in sql
+    assert date(2021, 3, 2) in params
+    cached = local_api.core.todays_data
+    assert [row[0] for row in cached["datasets"]["daily_cases"]] == [
+        date(2021, 3, 1), date(2021, 3, 2), date(2021, 3, 3)
+    ]
+    assert cached["datasets"]["daily_cases"][1] == updated
+    assert cached["datasets"]["ave_cases"][1] == (date(2021, 3, 2),) + (Decimal("4"),) * 5
+    assert cached["datasets"]["ave_cases"][2] == (date(2021, 3, 3),) + (Decimal("5"),) * 5
+    assert cached["datasets"]["daily_vaccines"] == mock_datasets()["daily_vaccines"]
+    assert cached["max_updated_at"]["cases"] == datetime(2021, 3, 3, 12)
+    assert cached["payloads"] == {}
+    assert cached["data_version"] == 5
+
+
+def test_refresh_reloads_when_rows_were_deleted(monkeypatch, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "get_published", dict)
+    monkeypatch.setattr(local_api.core, "get_data_version", lambda: 5)
+    expired_cache(local_api, mock_datasets())
+    monkeypatch.setattr(
+        local_api.core.db, "fetch_data", MagicMock(return_value=[("cases", None, 0), ("vaccines", None, 1)])
+    )
+    get_combined_rows = MagicMock(return_value=mock_datasets())
+    monkeypatch.setattr(local_api.core, "get_combined_rows", get_combined_rows)
+
+    local_api.core.refresh_data()
+
+    get_combined_rows.assert_called_once_with()
+    assert local_api.core.todays_data["payloads"] == {}
+
+
+def test_unchanged_data_version_serves_cache(monkeypatch, local_api, freeze_datetime):
+    expired_cache(local_api, mock_datasets(), last_updated="2021-10-05 03:00:00.000000")
+    fetch_data = MagicMock(return_value=[(4,)])
+    monkeypatch.setattr(local_api.core.db, "fetch_data", fetch_data)
+
+    local_api.core.refresh_data()
+
+    fetch_data.assert_called_once_with("SELECT version FROM data_version WHERE id = 1;")
+    assert local_api.core.todays_data["payloads"] == {"rows": "stale payload"}
+
+
+def test_data_version_read_once_per_interval(monkeypatch, local_api):
+    fetch_data = MagicMock(side_effect=[[(4,)], psycopg2.OperationalError("timeout expired")])
+    monkeypatch.setattr(local_api.core.db, "fetch_data", fetch_data)
+
+    assert local_api.core.get_data_version() == 4
+    assert local_api.core.get_data_version() == 4
+    assert fetch_data.call_count == 1
+
+    monkeypatch.setattr(local_api.core, "DATA_VERSION_CHECK_SECONDS", 0)
+    assert local_api.core.get_data_version() is None
+    monkeypatch.setattr(local_api.core, "DATA_VERSION_CHECK_SECONDS", 60)
+    assert local_api.core.get_data_version() is None  # a failed read isn't retried every request
+    assert fetch_data.call_count == 2
+
+
+def test_connect_times_out(monkeypatch, local_api):
+    connect = MagicMock(side_effect=psycopg2.OperationalError("timeout expired"))
+    monkeypatch.setattr(psycopg2, "connect", connect)
+
+    with pytest.raises(psycopg2.OperationalError):
+        local_api.core.db.fetch_data("SELECT 1;")
+    assert connect.call_args.kwargs["connect_timeout"] == local_api.core.db.CONNECT_TIMEOUT
+
+
+def test_new_data_version_refreshes_valid_cache(monkeypatch, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "get_published", dict)
+    expired_cache(local_api, mock_datasets(), last_updated="2021-10-05 03:00:00.000000")
+    fetch_data = MagicMock(side_effect=[[(5,)], [("cases", None, 1), ("vaccines", None, 1)]])
+    monkeypatch.setattr(local_api.core.db, "fetch_data", fetch_data)
+
+    local_api.core.refresh_data()
+
+    assert fetch_data.call_count == 2
+    assert local_api.core.todays_data["data_version"] == 5
+    assert local_api.core.todays_data["last_updated"] == "2021-10-05 03:02:01.142314"
+
+
+def test_concurrent_cold_misses_load_once(monkeypatch, local_api, mock_return, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "get_published", dict)
+    def slow_rows(*args, **kwargs):
+        time.sleep(0.05)
+        return []
+
+    cursor = mock_return.return_value.cursor.return_value
+    cursor.fetchall.side_effect = slow_rows
+    monkeypatch.setattr(local_api.core, "get_data_version", lambda: None)
+    refreshes = local_api.core.refresh_count
+    threads = [threading.Thread(target=local_api.core.refresh_data) for _ in range(8)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cursor.execute.call_count == 1
+    assert local_api.core.refresh_count == refreshes + 1
+    assert local_api.core.todays_data["datasets"]["daily_cases"] == []
+
+
+def test_expired_cache_served_while_revalidating(monkeypatch, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "STALE_WHILE_REVALIDATE", True)
+    monkeypatch.setattr(local_api.core, "get_data_version", lambda: 5)
+    expired_cache(local_api, mock_datasets())
+    stale = local_api.core.todays_data
+    loading = threading.Event()
+
+    def slow_rows():
+        loading.wait(1)
+        return mock_datasets()
+
+    get_combined_rows = MagicMock(side_effect=slow_rows)
+    monkeypatch.setattr(local_api.core, "get_combined_rows", get_combined_rows)
+    monkeypatch.setattr(local_api.core, "merge_updated_rows", lambda cached: None)
+
+    assert local_api.core.refresh_data() is stale
+    first_refresh = local_api.core.background_refresh
+    assert local_api.core.refresh_data() is stale
+    assert local_api.core.background_refresh is first_refresh
+
+    loading.set()
+    first_refresh.join()
+
+    get_combined_rows.assert_called_once_with()
+    assert local_api.core.todays_data is not stale
+    assert local_api.core.todays_data["data_version"] == 5
+    assert stale["payloads"] == {"rows": "stale payload"}
+
+
+def test_native_handler_matches_flask_app(monkeypatch, apigw_event, local_api, freeze_datetime):
+    from src.api import handler
+
+    monkeypatch.setattr(local_api.core, "get_combined_rows", mock_datasets)
+    apigw_event["headers"]["Origin"] = "https://example.org"
+
+    for params, encoding in [
+        ({}, "identity"),
+        ({}, "gzip"),
+        ({"format": "columnar", "fields": "positive_increase"}, "identity"),
+        ({"format": "xml"}, "identity"),
+    ]:
+        apigw_event["queryStringParameters"] = params
+        apigw_event["headers"]["Accept-Encoding"] = encoding
+        expected = local_api.app(apigw_event, "")
+        ret = handler.handler(apigw_event, "")
+
+        assert ret["statusCode"] == expected["statusCode"]
+        assert ret["body"] == expected["body"]
+        assert ret.get("isBase64Encoded") == expected.get("isBase64Encoded")
+        flask_headers = {k: v for k, v in expected["headers"].items() if k != "Content-Length"}
+        assert ret["headers"] == flask_headers
+        assert ret["headers"]["Access-Control-Allow-Origin"] == "https://example.org"
+
+    apigw_event["queryStringParameters"] = {}
+    apigw_event["headers"]["Accept-Encoding"] = "gzip"
+    ret = handler.handler(apigw_event, "")
+    assert ret["isBase64Encoded"]
+    assert ret["headers"]["Vary"] == "Accept-Encoding, Origin"
+    assert decode_body(ret)["data"] == local_api.core.format_datasets(mock_datasets(), "rows")
+
+
+def test_native_handler_routing(apigw_event, local_api):
+    from src.api import handler
+
+    apigw_event.update(path="/health/", httpMethod="OPTIONS")
+    apigw_event["headers"].update(
+        {"Access-Control-Request-Method": "GET", "Access-Control-Request-Headers": "content-type"}
+    )
+    ret = handler.handler(apigw_event, "")
+    assert ret["statusCode"] == 200
+    assert ret["headers"]["Access-Control-Allow-Headers"] == "content-type"
+    assert ret["headers"]["Access-Control-Allow-Origin"] == "*"
+
+    apigw_event["httpMethod"] = "POST"
+    assert handler.handler(apigw_event, "")["statusCode"] == 405
+    apigw_event["path"] = "/nope/"
+    assert handler.handler(apigw_event, "")["statusCode"] == 404
+
+    apigw_event.update(path="/invalidate_cache/", httpMethod="POST")
+    apigw_event["headers"]["invalidate-cache-key"] = "wrong"
+    assert handler.handler(apigw_event, "")["statusCode"] == 403
+
+
+def test_export_streams_from_named_cursor(monkeypatch, apigw_event, local_api):
+    monkeypatch.setattr(local_api.core, "EXPORT_CHUNK_ROWS", 2)
+    rows = mock_datasets()["daily_cases"] * 3
+    conn = pooled_connection()
+    monkeypatch.setattr(psycopg2, "connect", MagicMock(return_value=conn))
+    cursor = conn.cursor.return_value
+    cursor.fetchmany.side_effect = [rows[:2], rows[2:], []]
+    apigw_event.update(path="/export/cases", httpMethod="GET")
+    apigw_event["queryStringParameters"] = {"since": "2021-03-01"}
+
+    ret = local_api.app(apigw_event, "")
+
+    lines = ret["body"].splitlines()
+    assert ret["statusCode"] == 200
+    assert ret["headers"]["Content-Type"] == "text/csv"
+    assert lines[0] == ",".join(local_api.core.DAILY_CASES_COLUMNS)
+    assert lines[1:] == ["2021-03-01,1,1,1,1,1,1,1,1,1,2021-03-01 05:00:00,2021-03-01 05:00:00"] * 3
+    conn.cursor.assert_called_with(name="stream_data")
+    cursor.fetchmany.assert_called_with(2)
+    sql, params = cursor.execute.call_args[0]
+    assert "reporting_date >= %s" in sql
+    assert params == [date(2021, 3, 1)]
+    assert conn.autocommit is True
+    assert local_api.core.db.idle_connections[0][0] is conn
+
+
+def test_export_ndjson_and_errors(apigw_event, local_api, mock_return):
+    cursor = mock_return.return_value.cursor.return_value
+    cursor.fetchmany.side_effect = [mock_datasets()["daily_vaccines"], []]
+    apigw_event.update(path="/export/vaccines", httpMethod="GET")
+    apigw_event["queryStringParameters"] = {"format": "ndjson"}
+
+    ret = local_api.app(apigw_event, "")
+
+    assert ret["headers"]["Content-Type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in ret["body"].splitlines()] == local_api.core.format_data(
+        mock_datasets()["daily_vaccines"], local_api.core.DAILY_VACCINES_COLUMNS
+    )
+
+    apigw_event["queryStringParameters"] = {"format": "xlsx"}
+    assert local_api.app(apigw_event, "")["statusCode"] == 400
+    apigw_event["queryStringParameters"] = {}
+    apigw_event["path"] = "/export/passwords"
+    assert local_api.app(apigw_event, "")["statusCode"] == 404
+
+
+def reference_lttb(points_xy, threshold):
+    def edge(i):  # floor(i * every) + 1 without float rounding
+        return i * (len(points_xy) - 2) // (threshold - 2) + 1
+
+    kept = [0]
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edge(i), edge(i + 1)
+        next_end = min(edge(i + 2), len(points_xy))
+        following = points_xy[end:next_end] or points_xy[-1:]
+        avg_x = sum(x for x, _ in following) / len(following)
+        avg_y = sum(y for _, y in following) / len(following)
+        ax, ay = points_xy[previous]
+        areas = [
+            abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            for x, y in points_xy[start:end]
+        ]
+        previous = start + areas.index(max(areas))
+        kept.append(previous)
+    return kept + [len(points_xy) - 1]
+
+
+def series_datasets(days):
+    start = date(2021, 3, 1)
+    rows = []
+    for i in range(days):
+        value = (i * 37) % 101 * (i % 5)
+        rows.append((start + timedelta(days=i),) + (value,) * 9 + (datetime(2021, 3, 1),) * 2)
+    return {"daily_cases": rows}
+
+
+def test_lttb_matches_reference(local_api):
+    rows = series_datasets(400)["daily_cases"]
+    points_xy = [(float(i), float(row[5])) for i, row in enumerate(rows)]
+
+    dates, values = local_api.core.downsample_series(
+        series_datasets(400), "positive_increase", 50, "lttb"
+    )
+
+    kept = reference_lttb(points_xy, 50)
+    assert dates == [str(rows[i][0]) for i in kept]
+    assert values == [points_xy[i][1] for i in kept]
+
+
+def test_lttb_matches_reference_on_random_series(local_api):
+    rng = random.Random(0)
+    for _ in range(300):
+        n = rng.randint(10, 200)
+        points = rng.randint(3, n - 1)
+        x = sorted(rng.sample(range(10 * n), n))  # uneven gaps, like days with missing values
+        y = [rng.uniform(-1000, 1000) for _ in range(n)]
+
+        keep = local_api.core.lttb_indexes(np.array(x, dtype=float), np.array(y), points)
+
+        assert keep.tolist() == reference_lttb(list(zip(x, y)), points), (n, points)
+
+
+def test_bucketed_series(local_api):
+    datasets = series_datasets(10)  # 2021-03-01 is a Monday
+    row = datasets["daily_cases"][1]
+    datasets["daily_cases"][1] = row[:2] + (None,) + row[3:]
+
+    dates, values = local_api.core.downsample_series(
+        datasets, "hospitalized_currently", None, "weekly"
+    )
+
+    first_week = [row[2] for row in datasets["daily_cases"][:7] if row[2] is not None]
+    assert dates == ["2021-03-01", "2021-03-08"]
+    assert values[0] == round(sum(first_week) / len(first_week), 2)
+
+    dates, _ = local_api.core.downsample_series(datasets, "hospitalized_currently", None, "monthly")
+    assert dates == ["2021-03-01"]
+
+
+def test_series_endpoint(monkeypatch, apigw_event, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "get_combined_rows", mock_datasets)
+    apigw_event.update(path="/series/")
+    apigw_event["queryStringParameters"] = {
+        "column": "daily_qty", "algorithm": "monthly", "points": "10"
+    }
+
+    data = decode_body(local_api.app(apigw_event, ""))["data"]
+    local_api.app(apigw_event, "")
+
+    assert data == {
+        "column": "daily_qty", "algorithm": "monthly", "reporting_date": ["2021-03-01"], "daily_qty": [3.0]
+    }
+    assert list(local_api.core.todays_data["slices"]) == [("series", "daily_qty", None, "monthly")]
+
+    for params in [
+        {"column": "created_at"},
+        {"column": "daily_qty", "points": "2"},
+        {"column": "daily_qty", "algorithm": "max"},
+    ]:
+        apigw_event["queryStringParameters"] = params
+        assert local_api.app(apigw_event, "")["statusCode"] == 400
+
+
+@pytest.mark.parametrize(
+    "now, published, max_age",
+    [
+        (datetime(2021, 10, 5, 3, 2, 1), {}, 68279),  # until 22:00
+        (datetime(2021, 10, 5, 23, 0), {"cases": datetime(2021, 10, 4, 22, 30)}, 60),
+        (
+            datetime(2021, 10, 5, 23, 0),
+            {"cases": datetime(2021, 10, 5, 22, 30), "vaccines": datetime(2021, 10, 5, 22, 40)},
+            82800,
+        ),
+        (
+            datetime(2021, 10, 6, 1, 0),
+            {"cases": datetime(2021, 10, 5, 22, 10), "vaccines": datetime(2021, 10, 4, 22, 40)},
+            60,
+        ),
+    ],
+)
+def test_freshness_headers(monkeypatch, local_api, now, published, max_age):
+    class frozen(datetime):
+        @classmethod
+        def utcnow(cls):
+            return now
+
+    monkeypatch.setattr(local_api.core, "datetime", frozen)
+
+    headers = local_api.core.freshness_headers(published)
+
+    assert headers["Cache-Control"] == f"public, max-age={max_age}, stale-while-revalidate=300"
+    expires = datetime.strptime(headers["Expires"], "%a, %d %b %Y %H:%M:%S GMT")
+    assert expires == now + timedelta(seconds=max_age)
+    if published:
+        assert headers["Last-Modified"] == local_api.core.http_date(max(published.values()))
+
+
+def test_data_response_cache_headers(apigw_event, local_api, freeze_datetime):
+    cache_payload(local_api, "mock", "2021-10-05 03:00:00.000000")
+    local_api.core.todays_data["published"] = {"cases": datetime(2021, 10, 4, 22, 30)}
+
+    ret = local_api.app(apigw_event, "")
+    assert ret["headers"]["Cache-Control"].startswith("public, max-age=68278,")
+    assert ret["headers"]["Last-Modified"] == "Mon, 04 Oct 2021 22:30:00 GMT"
+
+    apigw_event["headers"]["If-None-Match"] = ret["headers"]["ETag"]
+    ret = local_api.app(apigw_event, "")
+    assert ret["statusCode"] == 304
+    assert "Expires" in ret["headers"]
+
+
+def test_metrics_endpoint(monkeypatch, apigw_event, local_api, freeze_datetime, capsys):
+    monkeypatch.setattr(local_api.core, "get_combined_rows", mock_datasets)
+    local_api.app(apigw_event, "")
+    local_api.app(apigw_event, "")
+
+    emf = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert emf[0]["Route"] == "/data/"
+    assert emf[0]["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Route"]]
+    assert {"format", "encode", "total"} <= set(emf[0])
+    assert "format" not in emf[1]
+
+    apigw_event["path"] = "/metrics/"
+    data = json.loads(local_api.app(apigw_event, "")["body"])
+
+    assert data["cache"] == {"cache_hits": 1, "cache_misses": 1, "hit_ratio": 0.5}
+    assert data["phases"]["total"]["count"] == 2
+    assert data["phases"]["encode"]["p50"] <= data["phases"]["encode"]["p99"]
+
+
+def test_refresh_after_invalidation_while_waiting(monkeypatch, local_api, freeze_datetime):
+    monkeypatch.setattr(local_api.core, "get_published", dict)
+    monkeypatch.setattr(local_api.core, "get_combined_rows", mock_datasets)
+    lock = local_api.core.refresh_lock
+
+    class LoadedThenInvalidated:
+        """Another request loads the data, then it's invalidated, while this one waits"""
+
+        def __enter__(self):
+            lock.acquire()
+            local_api.core.refresh_count += 1
+            local_api.core.todays_data = None
+
+        def __exit__(self, *args):
+            lock.release()
+
+    monkeypatch.setattr(local_api.core, "refresh_lock", LoadedThenInvalidated())
+
+    cached = local_api.core.refresh_data()
+
+    assert cached["datasets"] == mock_datasets()
@@ -0,0 +1,516 @@
+import gzip
+import hashlib
+import io
+import json
+import threading
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock
+from urllib.parse import parse_qsl, urlparse
+
+import boto3
+import psycopg2
+import pytest
+from moto import mock_aws
+
+from src.data import archive, db, fetch, increases
+
+
+@pytest.fixture(autouse=True)
+def shared_connection(mock_return):
+    """Each test starts without a connection left open by the last one"""
+    db.connection = None
+    mock_return.return_value.closed = 0
+    yield mock_return.return_value
+    db.connection = None
+
+
+def bulk_cursor(*pages):
+    cur = MagicMock()
+    cur.connection.encoding = "UTF8"
+    cur.mogrify.side_effect = lambda template, args: repr(args).encode("utf-8")
+    cur.fetchall.side_effect = list(pages)
+    return cur
+
+
+def test_upsert_rows_pages_and_counts():
+    cur = bulk_cursor([(True,), (False,)], [(True,)])
+    rows = [("2021-03-01", 1), ("2021-03-02", 2), ("2021-03-01", 3), ("2021-03-03", 4)]
+
+    counts = db.upsert_rows(cur, "cases", ["reporting_date", "positive"], rows, page_size=2)
+
+    assert counts == {"inserted": 2, "updated": 1}
+    assert cur.execute.call_count == 2
+    sql = cur.execute.call_args_list[0][0][0].decode("utf-8")
+    assert "ON CONFLICT (reporting_date) DO UPDATE SET positive = EXCLUDED.positive" in sql
+    assert "('2021-03-01', 3),('2021-03-02', 2)" in sql  # the later duplicate wins
+
+
+def test_save_case_data_in_session(monkeypatch, mock_return):
+    from src.data import cases
+
+    upsert_rows = MagicMock(return_value={"inserted": 1, "updated": 0})
+    monkeypatch.setattr(cases.db, "upsert_rows", upsert_rows)
+    day = {
+        "reporting_date": "2021-03-01",
+        "positive": 10,
+        "hospitalizations": 2,
+        "death_confirmed": 1,
+        "positive_increase": 3,
+        "death_increase": 0,
+        "hospitalized_increase": 1,
+        "tested": 50,
+        "tested_increase": 5,
+    }
+
+    with db.session():
+        assert cases.save_case_data_to_db([day]) == {"inserted": 1, "updated": 0}
+        conn = mock_return.return_value
+        conn.commit.assert_not_called()
+
+    assert upsert_rows.call_args[0][3] == [("2021-03-01", 10, 2, 1, 3, 0, 1, 50, 5)]
+    assert conn.cursor.return_value.execute.call_args[0] == (db.BUMP_DATA_VERSION_SQL,)
+    conn.commit.assert_called_once_with()
+    conn.close.assert_not_called()
+
+
+def test_changed_rows_skips_matching_fingerprints():
+    columns = ["reporting_date", "positive", "tested"]
+    rows = [("2021-03-01", 10, None), ("2021-03-02", 12, 5), ("2021-03-03", 15, 6)]
+    fingerprints = {
+        "2021-03-01": hashlib.md5(b"(10,)").hexdigest(),  # ROW(10, NULL)::text
+        "2021-03-02": hashlib.md5(b"(11,5)").hexdigest(),
+    }
+
+    changed, summary = db.changed_rows(rows, fingerprints, columns)
+
+    assert changed == rows[1:]
+    assert summary == {"new": 1, "changed": 1, "unchanged": 1}
+
+
+def test_save_case_data_skips_write_without_changes(monkeypatch, mock_return):
+    from src.data import cases
+
+    upsert_rows = MagicMock()
+    monkeypatch.setattr(cases.db, "upsert_rows", upsert_rows)
+    monkeypatch.setattr(cases.db, "changed_rows", lambda rows, *args: ([], {"unchanged": 1}))
+
+    assert cases.save_case_data_to_db([]) == {"inserted": 0, "updated": 0}
+
+    upsert_rows.assert_not_called()
+    mock_return.return_value.commit.assert_not_called()
+
+
+def vaccine_feature(
+    publish_date, category, section, metric="Cumulative", type="All", value=10, date=None
+):
+    properties = {
+        "publish_date": publish_date,
+        "date": date or publish_date,
+        "category": category,
+        "section": section,
+        "metric": metric,
+        "type": type,
+        "value": value,
+    }
+    return {"type": "Feature", "properties": properties, "geometry": None}
+
+
+VACCINES_GEOJSON = {
+    "type": "FeatureCollection",
+    "name": "Vaccines – “features”",  # multibyte characters split across chunks
+    "features": [
+        vaccine_feature("03/04/2021", "Administration", "Doses"),
+        vaccine_feature("03/04/2021", "Cumulative counts to date", "State Data"),
+        vaccine_feature("03/05/2021", "Administration", "Doses"),
+        vaccine_feature("03/05/2021", "Administration", "Doses", metric="Weekly"),
+        vaccine_feature("03/05/2021", "Demographics", "Age"),
+        vaccine_feature("03/05/2021", "Cumulative counts to date", "State Data"),
+    ],
+    "crs": {"type": "name"},
+}
+
+
+def test_case_runs_share_one_connection_and_transaction(monkeypatch, mock_return):
+    from src.data import cases
+
+    conn = mock_return.return_value
+    statements = []
+    conn.cursor.return_value.execute.side_effect = lambda sql, *args: statements.append(sql)
+    conn.commit.side_effect = lambda: statements.append("COMMIT")
+    # no save in the last 12 hours, the last day saved, then a save on the second run
+    conn.cursor.return_value.fetchone.side_effect = [None, (date(2021, 3, 4),), (1,)]
+    counts = {"Cases": 1, "Tested": 1, "Deaths": 1, "Hosp": 1}
+    features = [{"properties": {"Date": f"03/0{day}/2021", **counts}} for day in range(1, 6)]
+    monkeypatch.setattr(cases, "get_raw_case_data", lambda: ({"features": features}, None))
+    monkeypatch.setattr(cases.archive, "save_archive", MagicMock())
+    upsert_rows = MagicMock(return_value={"inserted": 1, "updated": 0})
+    monkeypatch.setattr(cases.db, "upsert_rows", upsert_rows)
+    monkeypatch.setattr(cases, "update_currently_hospitalized", MagicMock())
+    monkeypatch.setattr(cases, "invalidate_cache", MagicMock())
+
+    assert cases.handler() == "Success"
+    assert cases.handler() == "Success"
+
+    mock_return.assert_called_once()
+    first_commit = statements.index("COMMIT")
+    assert db.BUMP_DATA_VERSION_SQL in statements[:first_commit]
+    assert statements[first_commit - 1].startswith("INSERT INTO invokes")
+
+
+def test_session_rolls_back_and_drops_broken_connections(mock_return):
+    conn = mock_return.return_value
+
+    with pytest.raises(ValueError):
+        with db.session():
+            raise ValueError("bad row")
+    conn.rollback.assert_called_once_with()
+    assert db.connection is conn
+
+    with pytest.raises(psycopg2.OperationalError):
+        with db.session():
+            raise psycopg2.OperationalError("server closed the connection")
+    conn.close.assert_called_once_with()
+    assert db.connection is None
+
+
+@pytest.fixture
+def arcgis_server():
+    """Local stand-in for the ArcGIS download and FeatureServer query endpoints"""
+    features = [{"properties": {"Date": f"03/0{day}/2021", "Cases": day}} for day in range(1, 6)]
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = dict(parse_qsl(url.query))
+            requests_seen.append((url.path, params, dict(self.headers)))
+            if url.path == "/cases.geojson":
+                if self.headers.get("If-None-Match") == '"v1"':
+                    return self.reply(304)
+                return self.reply(200, {"features": features}, {"ETag": '"v1"'})
+            if url.path == "/vaccines.geojson":
+                if self.headers.get("If-None-Match") == '"v1"':
+                    return self.reply(304)
+                return self.reply(200, VACCINES_GEOJSON, {"ETag": '"v1"'})
+
+            if params.get("returnCountOnly"):
+                matches = [f for f in features if f["properties"]["Date"] in params["where"]]
+                return self.reply(200, {"count": len(matches)})
+            offset, count = int(params["resultOffset"]), int(params["resultRecordCount"])
+            fields = params["outFields"].split(",")
+            matches = [
+                f for f in features
+                if params["where"] == "1=1" or f"'{f['properties']['Date']}'" in params["where"]
+            ]
+            page = [
+                {"properties": {field: f["properties"].get(field) for field in fields}}
+                for f in matches[offset : offset + count]
+            ]
+            body = {"features": page}
+            if offset + count < len(matches):
+                body["properties"] = {"exceededTransferLimit": True}
+            return self.reply(200, body)
+
+        def reply(self, status, body=None, headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if body is not None:
+                self.wfile.write(json.dumps(body, ensure_ascii=False).encode("utf-8"))
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    fetch.validators.clear()
+    yield f"http://127.0.0.1:{server.server_port}", requests_seen
+    server.shutdown()
+
+
+def test_conditional_download(arcgis_server):
+    base_url, requests_seen = arcgis_server
+    url = f"{base_url}/cases.geojson"
+
+    assert len(fetch.get_geojson(url)["features"]) == 5
+    assert fetch.get_geojson(url) is None
+    assert requests_seen[-1][2]["If-None-Match"] == '"v1"'
+
+    fetch.forget(url)
+    assert fetch.get_geojson(url) is not None
+
+
+def test_feature_server_query(monkeypatch, arcgis_server):
+    base_url, requests_seen = arcgis_server
+    layer_url = f"{base_url}/layer"
+    monkeypatch.setattr(fetch, "PAGE_SIZE", 2)
+
+    assert fetch.count_features(layer_url, "Date = '03/06/2021'") == 0
+    assert fetch.count_features(layer_url, "Date = '03/05/2021'") == 1
+    data = fetch.query_features(layer_url, "1=1", ["Date"], order_by="Date")
+
+    assert data["features"][-1] == {"properties": {"Date": "03/05/2021"}}
+    assert len(data["features"]) == 5
+    assert [params["resultOffset"] for _, params, _ in requests_seen[2:]] == ["0", "2", "4"]
+
+
+def test_unchanged_case_poll_skips_cleaning(monkeypatch, arcgis_server):
+    from src.data import cases
+
+    base_url, _ = arcgis_server
+    monkeypatch.setattr(cases, "LAYER_URL", f"{base_url}/layer")
+    monkeypatch.setattr(cases, "next_day", lambda: "03/06/2021")
+    monkeypatch.setattr(cases, "already_saved_todays_data", lambda: False)
+    log_update_time = MagicMock()
+    monkeypatch.setattr(cases, "log_update_time", log_update_time)
+    clean_cases_data = MagicMock()
+    monkeypatch.setattr(cases, "clean_cases_data", clean_cases_data)
+
+    assert cases.handler() == "Success"
+
+    clean_cases_data.assert_not_called()
+    log_update_time.assert_called_once_with(new_data=False)
+
+
+def test_layer_poll_only_pulls_days_cleaning_uses(monkeypatch, arcgis_server):
+    from src.data import cases
+
+    base_url, requests_seen = arcgis_server
+    monkeypatch.setattr(cases, "LAYER_URL", f"{base_url}/layer")
+    monkeypatch.setattr(cases, "next_day", lambda: "03/05/2021")
+    monkeypatch.setattr(cases, "REVISION_DAYS", 2)
+
+    raw_data, raw_archive = cases.get_raw_case_data()
+    raw_archive.close()
+
+    dates = [feature["properties"]["Date"] for feature in raw_data["features"]]
+    assert dates == ["03/02/2021", "03/03/2021", "03/04/2021", "03/05/2021"]
+    where = requests_seen[-1][1]["where"]
+    assert where.startswith("Date IN ('03/02/2021', '03/03/2021', ")
+    assert where.count("'") == 2 * (cases.LAYER_MAX_DAYS + 1)
+
+
+def test_iter_features_streams_raw_bytes(arcgis_server):
+    base_url, _ = arcgis_server
+    raw_file = io.BytesIO()
+
+    response = fetch.open_geojson(f"{base_url}/vaccines.geojson")
+    with response:
+        features = list(fetch.iter_features(response, raw_file, chunk_size=7))
+
+    assert features == VACCINES_GEOJSON["features"]
+    assert raw_file.getvalue() == json.dumps(VACCINES_GEOJSON, ensure_ascii=False).encode("utf-8")
+
+
+def test_iter_features_truncated():
+    response = MagicMock(url="truncated")
+    response.iter_content.return_value = [b'{"features": [{"properties": {}}, {"prop']
+
+    with pytest.raises(ValueError):
+        list(fetch.iter_features(response))
+
+
+def test_stream_vaccine_data_keeps_cleaned_features(monkeypatch, arcgis_server):
+    from src.data import vaccines
+
+    base_url, _ = arcgis_server
+    monkeypatch.setattr(vaccines, "API_URL", f"{base_url}/vaccines.geojson")
+
+    raw_archive, vaccine_data, new_dates = vaccines.stream_raw_vaccine_data("03/05/2021")
+
+    raw_archive.compressed.close()
+    raw_archive.file.seek(0)
+    raw_bytes = gzip.decompress(raw_archive.file.read())
+    raw_archive.close()
+    assert json.loads(raw_bytes) == VACCINES_GEOJSON
+    assert raw_archive.hash.hexdigest() == hashlib.sha256(raw_bytes).hexdigest()
+    kept = [feature["properties"] for feature in vaccine_data["features"]]
+    assert [(cat["publish_date"], cat["category"]) for cat in kept] == [
+        ("03/04/2021", "Cumulative counts to date"),
+        ("03/05/2021", "Administration"),
+        ("03/05/2021", "Cumulative counts to date"),
+    ]
+    assert new_dates == [date(2021, 3, 5)]
+    fetch.forget(vaccines.API_URL)
+    assert vaccines.stream_raw_vaccine_data("03/06/2021") == (None, None, [])
+
+
+@mock_aws
+def test_archive_dedupes_content_by_hash():
+    s3_client = boto3.session.Session().client("s3", region_name="us-east-1")
+    s3_client.create_bucket(Bucket="archive")
+
+    def save(data, day):
+        return archive.save(s3_client, "archive", "raw", archive.archive_json(data), day=day)
+
+    key, changed = save(VACCINES_GEOJSON, "2021-03-04")
+    assert changed
+    assert save(VACCINES_GEOJSON, "2021-03-05") == (key, False)
+    empty_key, changed = save({"features": []}, "2021-03-06")
+    assert changed
+
+    objects = s3_client.list_objects_v2(Bucket="archive")["Contents"]
+    assert sorted(item["Key"] for item in objects) == sorted([key, empty_key, "raw/manifest.json"])
+    manifest = archive.get_manifest(s3_client, "archive", "raw")
+    assert manifest["2021-03-04"] == manifest["2021-03-05"] == key[4:-8]
+    assert json.loads(archive.load(s3_client, "archive", "raw", "2021-03-05")) == VACCINES_GEOJSON
+    assert archive.load(s3_client, "archive", "raw", "2021-03-07") is None
+
+
+@pytest.mark.parametrize("stream_parse", [True, False])
+def test_unchanged_vaccine_poll_skips_cleaning(monkeypatch, arcgis_server, stream_parse):
+    from src.data import vaccines
+
+    base_url, _ = arcgis_server
+    monkeypatch.setattr(vaccines, "API_URL", f"{base_url}/vaccines.geojson")
+    monkeypatch.setattr(vaccines, "STREAM_PARSE", stream_parse)
+    monkeypatch.setattr(vaccines, "already_saved_todays_data", lambda: False)
+    monkeypatch.setattr(vaccines, "get_run_context", lambda: {"new_day": "03/05/2021"})
+    log_update_time = MagicMock()
+    monkeypatch.setattr(vaccines, "log_update_time", log_update_time)
+    clean_vaccine_data = MagicMock()
+    monkeypatch.setattr(vaccines, "clean_vaccine_data", clean_vaccine_data)
+    fetch.get_geojson(vaccines.API_URL)  # an earlier poll saw this version
+
+    assert vaccines.handler() == "Success"
+
+    clean_vaccine_data.assert_not_called()
+    log_update_time.assert_called_once_with(new_data=False)
+
+
+def test_new_case_dates_only_look_at_date_field(monkeypatch):
+    from src.data import cases
+
+    monkeypatch.setattr(
+        cases, "fetch_latest_day_data", lambda: {"reporting_date": date(2021, 3, 4)}
+    )
+    raw_data = {
+        "features": [
+            {"properties": {"Date": "03/04/2021", "Note": "revised 03/05/2021"}},
+            {"properties": {"Date": None}},
+        ]
+    }
+    assert cases.get_new_dates(raw_data) == []
+
+    raw_data["features"].append({"properties": {"Date": "03/06/2021"}})
+    assert cases.get_new_dates(raw_data) == [date(2021, 3, 6)]
+
+
+def test_clean_cases_data_since():
+    from src.data import cases
+
+    raw_data = {
+        "features": [
+            {
+                "properties": {
+                    "Date": f"03/0{day}/2021",
+                    "Cases": day * 10,
+                    "Tested": day * 100,
+                    "Deaths": day,
+                    "Hosp": day * 2,
+                }
+            }
+            for day in [5, 1, 4, 2, 3]
+        ]
+    }
+    everything = cases.clean_cases_data(raw_data)
+    recent = cases.clean_cases_data(raw_data, since=date(2021, 3, 4))
+
+    assert recent == everything[-2:]
+    assert recent[0]["positive_increase"] == 10
+
+
+def test_clean_vaccine_data_only_uses_run_context(mock_return):
+    from src.data import vaccines
+
+    def administered(publish_date, value, date=None):
+        return vaccine_feature(
+            publish_date, "Administration", "Doses", "Cumulative Daily", "All COVID Vaccines",
+            value, date,
+        )
+
+    distributed = vaccine_feature(
+        "03/05/2021", "Cumulative counts to date", "State Data", "Cumulative Doses Distributed",
+        value=500,
+    )
+    raw_data = {
+        "features": [
+            administered("03/05/2021", 100, date="03/04/2021"),
+            administered("03/05/2021", 130),
+            administered("03/04/2021", 90),  # an earlier publish, left out
+            distributed,
+        ]
+    }
+
+    days = vaccines.clean_vaccine_data(raw_data, {"new_day": "03/05/2021"})
+
+    mock_return.assert_not_called()
+    assert [(day["date"], day["daily_cumulative"], day["daily_increase"]) for day in days] == [
+        ("03/04/2021", 100, 100),
+        ("03/05/2021", 130, 30),
+    ]
+    assert days[1]["distributed_cumulative"] == 500
+
+
+def test_clean_vaccine_data_merges_counts_by_date():
+    from src.data import vaccines
+
+    def administered(metric, type, value, date="03/04/2021"):
+        return vaccine_feature("03/05/2021", "Administration", "Doses", metric, type, value, date)
+
+    def state(metric, value):
+        return vaccine_feature(
+            "03/04/2021", "Cumulative counts to date", "State Data", metric, value=value
+        )
+
+    raw_data = {
+        "features": [
+            administered("Daily", "Pfizer", 7),
+            administered("Daily", "All COVID Vaccines", 9),  # not what it says, dropped
+            state("People Fully Immunized", 40),
+            administered("Cumulative Daily", "All COVID Vaccines", 95),
+            administered(None, None, 1),  # no metric
+            administered("People Fully Immunized", None, 30),  # state counts win
+            administered("Weekly Rolling", "Pfizer", 50),
+            administered("Daily", "Novavax", 3),  # unknown
+            administered("Daily", "Moderna", None),  # empty
+            state("Cumulative Doses Administered", "100"),
+        ]
+    }
+
+    assert vaccines.clean_vaccine_data(raw_data, {"new_day": "03/05/2021"}) == [
+        {
+            "date": "03/04/2021",
+            "pfizer_daily": 7,
+            "daily_cumulative": 100,
+            "fully_immunized_cumulative": 40,
+            "daily_increase": 100,
+            "distributed_increase": None,
+            "one_dose_increase": None,
+            "fully_immunized_increase": 40,
+        }
+    ]
+
+
+def test_add_increases_null_handling():
+    records = [
+        {"a": 1, "b": "n/a"},
+        {"a": 3, "b": 2, "c": 1.5},
+        {"b": 5, "c": 2},
+        {"a": 10, "c": None},
+    ]
+
+    increases.add_increases(records, [("a", "a_increase"), ("b", "b_increase"), ("c", "c_increase")])
+
+    assert [
+        (record["a_increase"], record["b_increase"], record["c_increase"]) for record in records
+    ] == [
+        (1, "n/a", None),  # the first record's values as they are
+        (2, None, 1.5),  # a column the record before didn't have counts as 0
+        (None, 3, 0.5),
+        (10, None, None),
+    ]
+    assert list(records[1]) == ["a", "b", "c", "a_increase", "b_increase", "c_increase"]